@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks the protocol layer: decompression, framing, decoding and encoding
+
+Replays a corpus of server traffic, split in the uncompressed login phase and
+the compressed game phase. By default the corpus is a synthetic one built from
+sample packets, the game phase mixed like a crowded town. A real corpus can be
+recorded by setting Client.record to a binary file opened for writing, then
+replayed with --corpus. Every decodable packet type is benchmarked, the ones
+missing from the corpus with a synthetic sample.
+
+Reports packets per second, bytes per second and, for every packet type,
+memory and blocks allocated per packet. Results can be saved as a baseline:
+later runs comparing against it fail when slower or allocating more than
+the baseline, beyond the given threshold.
+'''
+
+import sys
+import argparse
+import collections
+import gc
+import json
+import random
+import struct
+import time
+import tracemalloc
+import zlib
+
+from pyuo import loopback
+from pyuo import net
+from pyuo import packets
+
+
+## Relative weight of the packets in the synthetic corpus, default is 1
+WEIGHTS = {
+	0x1a: 8, 0x1c: 2, 0x1d: 10, 0x54: 6, 0x6e: 6, 0x70: 4, 0x77: 20, 0x78: 8,
+	0xa1: 3, 0xa2: 2, 0xa3: 2, 0xae: 4, 0xc0: 4, 0xc1: 3,
+}
+
+## Packets sent uncompressed during login, making the synthetic login phase
+LOGIN = (0x82, 0x8c, 0xa8)
+
+## Number of packets in the synthetic corpus, for every phase
+CORPUS_SIZE = 5000
+
+## Client packets to encode, with fill() arguments
+ENCODE = (
+	(packets.MoveRequestPacket, (2, 17)),
+	(packets.DoubleClickPacket, (0x40001234, )),
+	(packets.SingleClickPacket, (0x00000005, )),
+	(packets.GetPlayerStatusPacket, (packets.GetPlayerStatusPacket.TYP_BASE, 0x00000005)),
+	(packets.TargetCursorPacket, (0, 1, 0, 0x40001234)),
+	(packets.PingPacket, (7, )),
+	(packets.UnicodeSpeechRequestPacket, (0, 'ENU', 'Hail and well met', 0x03b2, 3)),
+	(packets.GumpResponsePacket, (0x1234, 0x99, 7, (3, ), {5: 'Bob'})),
+)
+
+
+def samples():
+	'''! Builds a sample of every server packet type
+	@return dict of raw uncompressed packets by ID
+	'''
+	pkt = loopback.LoopbackServer.packet
+	raws = {}
+
+	# Fixed layout packets accept any content
+	for cmd, cls in enumerate(packets.registry):
+		if cls is not None and cls.fieldsStruct is not None:
+			rnd = random.Random(cmd)
+			raws[cmd] = bytes([cmd] + [rnd.randrange(256) for i in range(cls.length - 1)])
+
+	raws[0x1a] = pkt(0x1a, 'IHHHbH', 0x40001234, 0x0eed, 1000, 1000 | 0x8000, 0, 0x0480,
+			variable=True)
+	raws[0x1c] = pkt(0x1c, 'IHBHH30s12s', 0x00000010, 0x0190, 0, 0x03b2, 3, b'Guard',
+			b'Hello world\x00', variable=True)
+	raws[0x3a] = pkt(0x3a, 'BHHHB', 0xff, 25, 1000, 987, 0, variable=True)
+	raws[0x3c] = pkt(0x3c, 'H' + 'IHBHHHIH' * 10, 10, *[v for i in range(10)
+			for v in (0x40000100 + i, 0x0eed, 0, 100, 40 + i, 60, 0x40000010, 0)], variable=True)
+	equip = [(0x40000200 + i, 0x1515 + i, i + 1) for i in range(5)]
+	raws[0x78] = pkt(0x78, 'IHHHbbHBB' + 'IHB' * 5 + 'I', 0x00000010, 0x0190, 1001, 1002, 0, 2,
+			0x83ea, 0, 1, *[v for e in equip for v in e], 0, variable=True)
+	raws[0xae] = pkt(0xae, 'IHBHH4s30s36s', 0x00000010, 0x0190, 0, 0x03b2, 3, b'ENU', b'Guard',
+			'Hail and well met\x00'.encode('utf_16_be'), variable=True)
+	raws[0xbf] = pkt(0xbf, 'HB', packets.GeneralInfoPacket.SUB_CURSORMAP, 1, variable=True)
+	raws[0x11] = pkt(0x11, 'I30sHHBBBHHHHHHHIHH', 0x00000005, b'Tester', 50, 60, 0, 1, 0,
+			80, 70, 60, 70, 70, 60, 60, 1500, 30, 200, variable=True)
+	raws[0x8c] = pkt(0x8c, '4sHI', b'\x7f\x00\x00\x01', 2593, 0x12345678)
+	tip = b'Welcome to the loopback shard!'
+	raws[0xa6] = pkt(0xa6, 'BIH{}s'.format(len(tip)), 0, 1, len(tip), tip, variable=True)
+	raws[0xa8] = pkt(0xa8, 'BH' + 'H32sBB4s' * 2, 0x5d, 2, 0, b'Shard one', 0, 0,
+			b'\x01\x00\x00\x7f', 1, b'Shard two', 0, 0, b'\x02\x00\x00\x7f', variable=True)
+	raws[0xa9] = pkt(0xa9, 'B30s30s30s30sBB31s31sI', 2, b'Tester', b'', b'Other', b'',
+			1, 0, b'Britain', b'Sweet Dreams Inn', 0, variable=True)
+	gumpTexts = [t.encode('utf_16_be') for t in ('Make what?', 'Bandage')]
+	gumpLayout = b'{ page 0 }{ text 20 20 0 0 }{ button 20 40 4005 4007 1 0 1 }{ text 60 40 0 1 }'
+	raws[0xb0] = pkt(0xb0, 'IIIIH{}sH'.format(len(gumpLayout)) +
+			''.join(['H{}s'.format(len(t)) for t in gumpTexts]) + 'B',
+			0x1234, 0x98, 50, 60, len(gumpLayout), gumpLayout, len(gumpTexts),
+			*[v for t in gumpTexts for v in (len(t) // 2, t)], 0, variable=True)
+	raws[0xc1] = pkt(0xc1, 'IHBHHI30s4s', 0xffffffff, 0xffff, 6, 0x03b2, 3, 1042971, b'System',
+			b'\x00\x00\x00\x00', variable=True)
+
+	layout = b'{ page 0 }{ resizepic 0 0 5054 300 200 }{ text 20 20 0 0 }' + \
+			b''.join([b'{ button 20 %d 4005 4007 1 0 %d }' % (40 + i * 20, i + 1) for i in range(8)])
+	texts = 'Make what?'.encode('utf_16_be')
+	texts = struct.pack('>H', len(texts) // 2) + texts
+	def packed(data):
+		comp = zlib.compress(data)
+		return struct.pack('>II', len(comp) + 4, len(data)) + comp
+	body = struct.pack('>IIII', 0x1234, 0x99, 50, 60) + packed(layout) + \
+			struct.pack('>I', 1) + packed(texts)
+	raws[0xdd] = struct.pack('>BH', 0xdd, len(body) + 3) + body
+
+	return raws
+
+
+def syntheticCorpus(raws, cmds=None):
+	'''! Builds a corpus mixing the given samples
+	@param raws dict: Samples by ID
+	@param cmds iterable: IDs of the samples to mix, default is all
+	@return list of raw uncompressed packets
+	'''
+	cmds = sorted(cmds if cmds is not None else raws.keys())
+	rnd = random.Random(0)
+	return rnd.choices([raws[c] for c in cmds], [WEIGHTS.get(c, 1) for c in cmds], k=CORPUS_SIZE)
+
+
+def loadCorpus(path):
+	'''! Loads a corpus recorded with Network.record, stopping at unknown packets
+	@param path string: The recorded file
+	@return tuple (uncompressed phase, compressed phase), lists of raw uncompressed packets
+	'''
+	streams = {False: bytearray(), True: bytearray()}
+	header = net.Network.RECORD_HEADER
+	with open(path, 'rb') as f:
+		data = f.read()
+	pos = 0
+	while pos + header.size <= len(data):
+		compress, size = header.unpack_from(data, pos)
+		pos += header.size
+		streams[compress] += data[pos:pos+size]
+		pos += size
+
+	# Uncompressed packets can't be split past an unknown one
+	plain = []
+	view = memoryview(streams[False])
+	while view and packets.lengths[view[0]] is not None:
+		length = net.PacketReader.frameLength(view)
+		if length is None or length > len(view):
+			break
+		plain.append(bytes(view[:length]))
+		view = view[length:]
+
+	raws = [bytes(raw) for raw, size in net.Decompressor().decompress(streams[True])]
+	compressed = [raw for raw in raws if packets.registry[raw[0]] is not None]
+	return plain, compressed
+
+
+def throughput(func, count, size, minTime, repeat=3):
+	'''! Runs func until at least minTime seconds elapsed, keeps the best of repeat runs
+	@param func callable: Processes count packets, size bytes in total
+	@return tuple (packets per second, bytes per second)
+	'''
+	best = 0
+	for r in range(repeat):
+		loops = 0
+		start = time.perf_counter()
+		while True:
+			func()
+			loops += 1
+			elapsed = time.perf_counter() - start
+			if elapsed >= minTime:
+				break
+		best = max(best, loops / elapsed)
+	return count * best, size * best
+
+
+def allocations(make, count=1000):
+	'''! Measures the memory retained by the objects built by make
+	@return tuple (bytes per object, blocks per object)
+	'''
+	keep = [None] * count
+	gc.collect()
+	gc.disable()
+	tracemalloc.start()
+	blocks = sys.getallocatedblocks()
+	for i in range(count):
+		keep[i] = make()
+	size = tracemalloc.get_traced_memory()[0]
+	blocks = sys.getallocatedblocks() - blocks
+	tracemalloc.stop()
+	gc.enable()
+	return size / count, blocks / count
+
+
+def decodeOne(cls, raw):
+	''' Decodes a single packet '''
+	pkt = cls()
+	pkt.decode(raw)
+	return pkt
+
+
+def encodeOne(cls, args):
+	''' Fills and encodes a single packet '''
+	pkt = cls()
+	pkt.fill(*args)
+	return pkt.encode()
+
+
+def replay(stream, compress=True):
+	'''! Feeds a stream to a PacketReader and decodes everything
+	@param compress bool: Whether the stream is compressed
+	@return int: Number of packets
+	'''
+	reader = net.PacketReader()
+	reader.compress = compress
+	view = memoryview(stream)
+	count = 0
+	while view:
+		buf = reader.getBuffer()
+		read = min(len(buf), len(view))
+		buf[:read] = view[:read]
+		view = view[read:]
+		reader.bufferUpdated(read)
+		while reader.available():
+			reader.decodeNext()
+			count += 1
+	return count
+
+
+def frame(stream):
+	''' Splits an uncompressed stream using the registry '''
+	view = memoryview(stream)
+	pos = 0
+	while pos < len(view):
+		pos += net.PacketReader.frameLength(view[pos:])
+
+
+def run(plain, corpus, raws, minTime):
+	'''! Runs all the benchmarks on the given corpus
+	@param plain list: Raw packets of the uncompressed login phase
+	@param corpus list: Raw packets of the compressed game phase
+	@param raws dict: Samples by ID, for the types missing from the corpus
+	@param minTime float: Minimum duration of every measure, in seconds
+	@return dict of results by benchmark name, results are dicts
+	'''
+	results = collections.OrderedDict()
+	compressed = [net.Compressor.compress(raw) for raw in corpus]
+	stream = b''.join(compressed)
+	plainStream = b''.join(plain)
+
+	def measure(name, func, count, size):
+		pps, bps = throughput(func, count, size, minTime)
+		results[name] = {'pps': pps, 'bps': bps}
+		return results[name]
+
+	if plain:
+		measure('frame (login, uncompressed)', lambda: frame(plainStream), len(plain), len(plainStream))
+		measure('replay (login, uncompressed)', lambda: replay(plainStream, False),
+				len(plain), len(plainStream))
+	if corpus:
+		measure('decompress (streaming)', lambda: net.Decompressor().decompress(stream),
+				len(corpus), len(stream))
+		measure('decompress (one-shot)', lambda: [net.Network.decompress(c) for c in compressed],
+				len(corpus), len(stream))
+		measure('replay (game, decompress+decode)', lambda: replay(stream), len(corpus), len(stream))
+
+	# Every decodable type, the ones missing from the corpus with a synthetic sample
+	byCmd = dict(raws)
+	for raw in plain + corpus:
+		byCmd[raw[0]] = raw
+	for cmd in sorted(byCmd.keys()):
+		cls = packets.registry[cmd]
+		raw = byCmd[cmd]
+		res = measure('decode 0x{:02X} {}'.format(cmd, cls.__name__),
+				lambda: [decodeOne(cls, raw) for i in range(100)], 100, len(raw) * 100)
+		res['bytes'], res['blocks'] = allocations(lambda: decodeOne(cls, raw))
+
+	for cls, args in ENCODE:
+		size = len(encodeOne(cls, args))
+		res = measure('encode 0x{:02X} {}'.format(cls.cmd, cls.__name__),
+				lambda: [encodeOne(cls, args) for i in range(100)], 100, size * 100)
+		res['bytes'], res['blocks'] = allocations(lambda: encodeOne(cls, args))
+
+	return results
+
+
+def compare(results, baseline, threshold):
+	'''! Compares results with a baseline
+	@param threshold float: Tolerated relative regression, 0.25 = 25%
+	@return list of regression descriptions, empty if none
+	'''
+	failures = []
+	for name, res in results.items():
+		base = baseline.get(name)
+		if base is None:
+			continue
+		if res['pps'] < base['pps'] * (1 - threshold):
+			failures.append('{}: {:.0f} pkt/s, baseline {:.0f}'.format(name, res['pps'], base['pps']))
+		if 'blocks' in base and res['blocks'] > base['blocks'] * (1 + threshold) + 0.5:
+			failures.append('{}: {:.1f} blocks/pkt, baseline {:.1f}'.format(
+					name, res['blocks'], base['blocks']))
+	return failures
+
+
+def report(results):
+	''' Prints the results as a table '''
+	print('{:<44} {:>11} {:>9} {:>8} {:>8}'.format('benchmark', 'pkt/s', 'MB/s', 'B/pkt', 'blk/pkt'))
+	for name, res in results.items():
+		alloc = '{:>8.0f} {:>8.1f}'.format(res['bytes'], res['blocks']) if 'bytes' in res else ''
+		print('{:<44} {:>11.0f} {:>9.2f} {}'.format(name, res['pps'], res['bps'] / 1e6, alloc))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+	parser.add_argument('--corpus', help='server traffic recorded with Client.record')
+	parser.add_argument('--time', type=float, default=0.1,
+			help='minimum seconds for every run of a measure, best of 3 is kept')
+	parser.add_argument('--save', help='save the results as a JSON baseline')
+	parser.add_argument('--compare', help='fail on regressions against the given JSON baseline')
+	parser.add_argument('--threshold', type=float, default=0.25,
+			help='tolerated relative regression (default: 0.25)')
+	args = parser.parse_args()
+
+	raws = samples()
+	if args.corpus:
+		plain, corpus = loadCorpus(args.corpus)
+	else:
+		plain = syntheticCorpus(raws, LOGIN)
+		corpus = syntheticCorpus(raws, [c for c in raws.keys() if c not in LOGIN])
+	print('Corpus: {} login packets, {} game packets, {} bytes uncompressed'.format(
+			len(plain), len(corpus), sum(map(len, plain + corpus))))
+	results = run(plain, corpus, raws, args.time)
+	report(results)
+
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=1)
+
+	if args.compare:
+		with open(args.compare) as f:
+			failures = compare(results, json.load(f), args.threshold)
+		if failures:
+			print('\nRegressions:')
+			for failure in failures:
+				print(' ', failure)
+			sys.exit(1)
+		print('\nNo regressions')
@@ -1,6 +1,9 @@
 __all__ = [
+	'asyncnet',
 	'brain',
 	'client',
+	'gump',
+	'loopback',
 	'net',
 	'packets',
 ]
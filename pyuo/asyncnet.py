@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+'''
+asyncio network classes for Python Ultima Online text client
+Copyright (C) 2015-2016 Gabriele Tozzi
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+'''
+
+import asyncio
+import collections
+import logging
+
+from . import net
+
+
+class Protocol(asyncio.BufferedProtocol, net.PacketReader):
+	''' asyncio protocol, splits and decodes incoming data using the same
+	framing and decompression of net.Network
+
+	The event loop reads straight into the PacketReader's buffer.
+	'''
+
+	def __init__(self):
+		net.PacketReader.__init__(self)
+		## The transport, set when connected
+		self.transport = None
+		## Decoded packets not yet returned
+		self.packets = collections.deque()
+		## Exception that terminated the connection, None while connected
+		self.error = None
+		## Future set when a packet arrives or the connection is lost, internal usage
+		self.waiter = None
+		## Future set when writing can be resumed, None if not paused, internal usage
+		self.drainWaiter = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def get_buffer(self, sizehint):
+		return self.getBuffer()
+
+	def buffer_updated(self, nbytes):
+		try:
+			self.bufferUpdated(nbytes)
+			while self.available():
+				self.packets.append(self.decodeNext())
+		except Exception as e:
+			self.error = e
+			self.transport.close()
+		self.wakeup()
+
+	def eof_received(self):
+		self.error = net.DisconnectedError("Disconnected")
+		self.wakeup()
+
+	def connection_lost(self, exc):
+		if self.error is None:
+			self.error = exc if exc is not None else net.DisconnectedError("Disconnected")
+		self.wakeup()
+		self.resume_writing()
+
+	def pause_writing(self):
+		if self.drainWaiter is None:
+			self.drainWaiter = asyncio.get_running_loop().create_future()
+
+	def resume_writing(self):
+		if self.drainWaiter is not None:
+			if not self.drainWaiter.done():
+				self.drainWaiter.set_result(None)
+			self.drainWaiter = None
+
+	def wakeup(self):
+		''' Wakes up the coroutine waiting for packets, internal usage '''
+		if self.waiter is not None:
+			if not self.waiter.done():
+				self.waiter.set_result(None)
+			self.waiter = None
+
+	async def wait(self):
+		''' Waits until a packet arrives or the connection is lost, internal usage '''
+		assert self.waiter is None, 'Only one coroutine can read at a time'
+		self.waiter = asyncio.get_running_loop().create_future()
+		await self.waiter
+
+	async def drain(self):
+		''' Waits until the transport's write buffer has been flushed enough, internal usage '''
+		if self.drainWaiter is not None:
+			await self.drainWaiter
+
+
+class Network:
+	''' asyncio network handler, the coroutine based counterpart of net.Network
+
+	Many Network instances can share the same event loop. Iterating over an
+	instance with "async for" yields the incoming packets.
+	'''
+
+	def __init__(self, transport, protocol):
+		'''! Internal usage, use the connect() coroutine to get a connected instance
+		@param transport asyncio.Transport: The connected transport
+		@param protocol Protocol: The transport's protocol
+		'''
+		## Logger, for internal usage
+		self.log = logging.getLogger('net')
+		## Transport, for internal usage
+		self.transport = transport
+		## Protocol, for internal usage
+		self.protocol = protocol
+
+	@classmethod
+	async def connect(cls, ip, port):
+		'''! Connects to the server
+			@param ip IPv4Address: the IP object, from the ipaddress module
+			@param port int: the port
+			@return Network
+		'''
+		loop = asyncio.get_running_loop()
+		transport, protocol = await loop.create_connection(Protocol, str(ip), port)
+		return cls(transport, protocol)
+
+	@property
+	def compress(self):
+		''' Wether to use compression or not '''
+		return self.protocol.compress
+
+	@compress.setter
+	def compress(self, compress):
+		self.protocol.compress = compress
+
+	def close(self):
+		''' Disconnects, makes this object unusable '''
+		self.transport.close()
+
+	async def send(self, data):
+		''' Sends a packet or raw binary data '''
+		raw = net.Network.encode(data)
+		self.log.debug('-> 0x%0.2X, %d bytes\n"%s"', raw[0], len(raw), raw)
+		if self.protocol.error is not None:
+			raise self.protocol.error
+		self.transport.write(raw)
+		await self.protocol.drain()
+
+	async def recv(self):
+		'''! Waits for next packet from the server
+		@return Packet
+		'''
+		while not self.protocol.packets:
+			if self.protocol.error is not None:
+				raise self.protocol.error
+			await self.protocol.wait()
+		return self.protocol.packets.popleft()
+
+	async def recvMany(self):
+		'''! Waits for packets from the server, returns all the full packets available at once
+		@return list of Packet
+		'''
+		pkts = [ await self.recv() ]
+		while self.protocol.packets:
+			pkts.append(self.protocol.packets.popleft())
+		return pkts
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		try:
+			return await self.recv()
+		except net.DisconnectedError:
+			raise StopAsyncIteration
@@ -22,7 +22,8 @@ Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 import threading
 import logging
 import time
-import collections
+import heapq
+import queue
 
 
 class Brain:
@@ -37,15 +38,17 @@ class Brain:
 		'''
 		self.log = logging.getLogger('brain')
 		self.started = threading.Event()
-		self.events = collections.deque()
-		self.eventsLock = threading.Lock()
+		## Events posted by the client, internal usage
+		self.events = queue.Queue()
+		## Heap of the scheduled Timers, internal usage
+		self.timers = []
 		## Client reference
 		self.client = client
 		## Reference to current player
 		self.player = None
 		## Reference to list of known objects
 		self.objects = None
-		## Default timeout while waiting for events
+		## Interval between two calls of loop(), events are processed as soon as they arrive
 		self.timeout = 5
 
 		client.start(self)
@@ -63,6 +66,7 @@ class Brain:
 		self.init()
 
 		# Enter main loop
+		nextLoop = time.monotonic()
 		while True:
 			if not self.client.is_alive():
 				self.processEvents()
@@ -70,27 +74,32 @@ class Brain:
 				self.log.critical("Client crashed and didn't tell me.")
 				raise RuntimeError("Client crashed and didn't tell me.")
 
-			if self.loop():
-				self.log.info('Main loop terminated.')
-				break
-
-			# Wait for events
-			self.processEvents()
-			if not len(self.events) and self.timeout:
-				start = time.time()
-				timeout = start + self.timeout
-				while time.time() < timeout:
-					self.processEvents()
-					time.sleep(0.01)
-
-	def processEvents(self):
-		''' Process event queue, internal '''
-		while True:
-			with self.eventsLock:
-				if not len(self.events):
-					return
-				ev = self.events.popleft()
+			if time.monotonic() >= nextLoop:
+				if self.loop():
+					self.log.info('Main loop terminated.')
+					break
+				nextLoop = time.monotonic() + (self.timeout or 0)
+
+			# Sleep until next event, timer or loop
+			self.runTimers()
+			deadline = nextLoop
+			if self.timers:
+				deadline = min(deadline, self.timers[0].deadline)
+			self.processEvents(deadline - time.monotonic())
+
+	def processEvents(self, timeout=0):
+		'''! Process event queue, internal
+		@param timeout float: Seconds to wait for the first event, don't wait if <= 0
+		'''
+		try:
+			if timeout > 0:
+				ev = self.events.get(timeout=timeout)
+			else:
+				ev = self.events.get_nowait()
+		except queue.Empty:
+			return
 
+		while True:
 			if ev.type == Event.EVT_HP_CHANGED:
 				self.onHpChange(ev.old, ev.new)
 			elif ev.type == Event.EVT_MANA_CHANGED:
@@ -106,19 +115,48 @@ class Brain:
 						ev.x, ev.y, ev.z, ev.facing, ev.ack)
 			elif ev.type == Event.EVT_NEW_MOBILE:
 				self.onNewMobile(ev.mobile)
+			elif ev.type == Event.EVT_GUMP:
+				self.onGump(ev.gump)
 			elif ev.type == Event.EVT_CLIENT_CRASH:
-				self.log.critical('Oops! Client crashed:', evt.exception)
+				self.log.critical('Oops! Client crashed: %s', ev.exception)
 				raise RuntimeError('Oops! Client crashed')
 			else:
 				raise NotImplementedError("Unknown event {}",format(ev.type))
 
+			try:
+				ev = self.events.get_nowait()
+			except queue.Empty:
+				return
+
+	def runTimers(self):
+		''' Calls the callbacks of the expired timers, internal '''
+		now = time.monotonic()
+		while self.timers and self.timers[0].deadline <= now:
+			timer = heapq.heappop(self.timers)
+			if timer.cancelled:
+				continue
+			if timer.interval:
+				timer.deadline += timer.interval
+				heapq.heappush(self.timers, timer)
+			timer.callback(*timer.args)
+
+	def schedule(self, delay, callback, *args, interval=None):
+		'''! Schedules a callback, must be called from the brain thread
+		@param delay float: Seconds before the first call
+		@param callback callable: Called with args as arguments
+		@param interval float: If given, the callback is called again every interval seconds
+		@return Timer, can be used to cancel the callback
+		'''
+		timer = Timer(time.monotonic() + delay, interval, callback, args)
+		heapq.heappush(self.timers, timer)
+		return timer
+
 	def event(self, ev):
 		''' Internal function, injects a single event, called from the client thread '''
 		if not isinstance(ev, Event):
 			raise RuntimeError("Unknown event, expecting an Event instance, got {}".format(type(ev)))
 
-		with self.eventsLock:
-			self.events.append(ev)
+		self.events.put(ev)
 
 	def setTimeout(self, timeout):
 		''' Sets the new timeout in seconds for the main loop '''
@@ -169,9 +207,42 @@ class Brain:
 		''' Called when somebody said something or on a sys or global chat message '''
 		print('SPEECH received: {}'.format(speech))
 
+	def onGump(self, gump):
+		''' Called when a gump is received, reply with Client.respondGump() '''
+		print('GUMP received: {}'.format(gump))
+
+
+class Timer:
+	''' A callback scheduled with Brain.schedule() '''
+
+	__slots__ = ('deadline', 'interval', 'callback', 'args', 'cancelled')
+
+	def __init__(self, deadline, interval, callback, args):
+		## When the callback is due, in time.monotonic() seconds
+		self.deadline = deadline
+		## Interval between repeated calls, None if called once
+		self.interval = interval
+		self.callback = callback
+		self.args = args
+		## True if cancelled, it is removed from the heap only when due
+		self.cancelled = False
+
+	def cancel(self):
+		''' Cancels the callback, must be called from the brain thread '''
+		self.cancelled = True
+
+	def __lt__(self, other):
+		return self.deadline < other.deadline
+
 
 class Event:
-	''' An event sent from the client '''
+	''' An event sent from the client, base class
+
+	Every type of event has its own slotted class, telling its type in the
+	type class attribute
+	'''
+
+	__slots__ = ()
 
 	EVT_HP_CHANGED = 1
 	EVT_MANA_CHANGED = 2
@@ -180,10 +251,117 @@ class Event:
 	EVT_NOTORIETY = 5
 	EVT_MOVED = 6
 	EVT_NEW_MOBILE = 7
+	EVT_GUMP = 8
 
 	EVT_CLIENT_CRASH = 255
 
-	def __init__(self, type, **kwargs):
-		self.type = type
-		for k, v in kwargs.items():
-			setattr(self, k, v)
+	## The event type, one of the EVT_ constants
+	type = None
+
+	def __repr__(self):
+		values = ['{}={!r}'.format(name, getattr(self, name)) for cls in type(self).__mro__
+				for name in getattr(cls, '__slots__', ())]
+		return '<{} {}>'.format(self.__class__.__name__, ' '.join(values))
+
+
+class ChangeEvent(Event):
+	''' Base class for the events telling that a value changed '''
+
+	__slots__ = ('old', 'new')
+
+	def __init__(self, old, new):
+		## The previous value
+		self.old = old
+		## The new value
+		self.new = new
+
+
+class HpChangedEvent(ChangeEvent):
+	''' Player's HP changed '''
+
+	__slots__ = ()
+	type = Event.EVT_HP_CHANGED
+
+
+class ManaChangedEvent(ChangeEvent):
+	''' Player's mana changed '''
+
+	__slots__ = ()
+	type = Event.EVT_MANA_CHANGED
+
+
+class StamChangedEvent(ChangeEvent):
+	''' Player's stamina changed '''
+
+	__slots__ = ()
+	type = Event.EVT_STAM_CHANGED
+
+
+class NotorietyEvent(ChangeEvent):
+	''' Player's notoriety changed '''
+
+	__slots__ = ()
+	type = Event.EVT_NOTORIETY
+
+
+class SpeechEvent(Event):
+	''' Somebody said something '''
+
+	__slots__ = ('speech', )
+	type = Event.EVT_SPEECH
+
+	def __init__(self, speech):
+		## The Speech instance
+		self.speech = speech
+
+
+class MovedEvent(Event):
+	''' Player's movement has been confirmed or rejected '''
+
+	__slots__ = ('oldx', 'oldy', 'oldz', 'oldfacing', 'x', 'y', 'z', 'facing', 'ack')
+	type = Event.EVT_MOVED
+
+	def __init__(self, oldx, oldy, oldz, oldfacing, x, y, z, facing, ack):
+		self.oldx = oldx
+		self.oldy = oldy
+		self.oldz = oldz
+		self.oldfacing = oldfacing
+		self.x = x
+		self.y = y
+		self.z = z
+		self.facing = facing
+		## True if the movement has been acknowledged, False if rejected
+		self.ack = ack
+
+
+class NewMobileEvent(Event):
+	''' A new mobile came in sight '''
+
+	__slots__ = ('mobile', )
+	type = Event.EVT_NEW_MOBILE
+
+	def __init__(self, mobile):
+		## The Mobile instance
+		self.mobile = mobile
+
+
+class GumpEvent(Event):
+	''' A gump has been received '''
+
+	__slots__ = ('gump', )
+	type = Event.EVT_GUMP
+
+	def __init__(self, gump):
+		## The Gump instance
+		self.gump = gump
+
+
+class ClientCrashEvent(Event):
+	''' The client thread crashed '''
+
+	__slots__ = ('exception', )
+	type = Event.EVT_CLIENT_CRASH
+
+	def __init__(self, exception):
+		## The exception that terminated the client
+		self.exception = exception
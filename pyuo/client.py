@@ -28,10 +28,15 @@ import socket
 import ipaddress
 import time
 import traceback
+import selectors
+import itertools
+import operator
+import array
 
 from . import net
 from . import packets
 from . import brain
+from . import gump
 
 
 class status:
@@ -103,6 +108,8 @@ class Item(UOBject):
 		self.amount = 1
 		## Status flags
 		self.status = None
+		## Serial of the container or mobile holding this item, None if lying in the world
+		self.container = None
 
 		if pkt is not None:
 			self.update(pkt)
@@ -120,6 +127,7 @@ class Item(UOBject):
 		self.facing = pkt.facing
 		self.color = pkt.color if pkt.color else 0
 		self.status = pkt.flag
+		self.container = None
 
 	def upgradeToContainer(self):
 		''' Upgrade this item to a container '''
@@ -152,29 +160,47 @@ class Container(Item):
 		self.content = None
 
 	def addItem(self, pkt):
-		''' Adds an item to container, from packet or dictionary '''
-		if type(pkt) == dict:
+		''' Adds an item to container, from packet, ContainerItem or dictionary '''
+		if isinstance(pkt, packets.ContainerItem):
 			it = pkt
+		elif type(pkt) == dict:
+			it = packets.ContainerItem(pkt['serial'], pkt['graphic'], pkt.get('unknown', 0),
+					pkt['amount'], pkt['x'], pkt['y'], pkt['container'], pkt['color'])
 		elif isinstance(pkt, packets.AddItemToContainerPacket):
-			it = pkt.__dict__
+			it = packets.ContainerItem(pkt.serial, pkt.graphic, pkt.offset,
+					pkt.amount, pkt.x, pkt.y, pkt.container, pkt.color)
 		else:
 			raise ValueError("Expecting a AddItem(s)ToContainerPacket")
 
-		if it['serial'] in self.client.objects.keys():
-			item = self.client.objects[it['serial']]
-		else:
-			item = Item(self.client)
-			item.serial = it['serial']
-			self.client.objects[it['serial']] = item
-		item.graphic = it['graphic']
-		item.amount = it['amount']
-		item.x = it['x']
-		item.y = it['y']
-		item.color = it['color']
+		self.addItems((it, ))
 
+	def addItems(self, items):
+		'''! Adds many items to container at once
+		@param items iterable: ContainerItem records, as in AddItemsToContainerPacket
+		'''
+		objects = self.client.objects
+		grid = self.client.grid
+		index = self.client.index
 		if self.content is None:
 			self.content = []
-		self.content.append(item)
+		content = self.content
+
+		for serial, graphic, unknown, amount, x, y, container, color in items:
+			item = objects.get(serial)
+			if item is None:
+				item = Item(self.client)
+				item.serial = serial
+				objects[serial] = item
+			else:
+				grid.remove(serial)
+			item.graphic = graphic
+			item.amount = amount
+			item.x = x
+			item.y = y
+			item.color = color
+			item.container = container
+			index.update(item)
+			content.append(item)
 
 	def __iter__(self):
 		return self.content.__iter__()
@@ -289,19 +315,48 @@ class Mobile(UOBject):
 
 		# Handle equip
 		if isinstance(pkt, packets.DrawObjectPacket):
-			self.equip = {}
-			for eq in pkt.equip:
-				serial = eq['serial']
-				if serial in self.client.objects.keys():
-					item = self.client.objects[serial]
-				else:
+			self.updateEquip(pkt.equip)
+
+	def updateEquip(self, records):
+		'''! Updates the equipment, only the layers that changed are touched
+		@param records list of EquipItem: The whole equipment
+		'''
+		# Work on a copy, readers in other threads see the whole new equipment at once
+		equip = dict(self.equip or {})
+		dropped = []
+		for eq in records:
+			item = equip.get(eq.layer)
+			if item is None or item.serial != eq.serial:
+				if item is not None:
+					dropped.append(item)
+				item = self.client.objects.get(eq.serial)
+				if item is None:
 					item = Item(self.client)
-					item.serial = eq['serial']
+					item.serial = eq.serial
 					self.client.objects[item.serial] = item
-				item.graphic = eq['graphic']
-				item.color = eq['color']
-
-				self.equip[eq['layer']] = item
+				else:
+					self.client.grid.remove(eq.serial)
+				equip[eq.layer] = item
+			item.graphic = eq.graphic
+			item.color = eq.color
+			item.container = self.serial
+			self.client.index.update(item)
+
+		# Some layers have been emptied
+		if len(equip) != len(records):
+			layers = set([eq.layer for eq in records])
+			for layer in [l for l in equip.keys() if l not in layers]:
+				dropped.append(equip.pop(layer))
+
+		# Items no longer worn are not held by this mobile anymore
+		if dropped:
+			worn = set([eq.serial for eq in records])
+			for item in dropped:
+				if item.serial not in worn and item.container == self.serial:
+					item.container = None
+					self.client.index.update(item)
+
+		self.equip = equip
 
 	def getEquipByLayer(self, layer):
 		''' Returns item equipped in the given layer '''
@@ -331,6 +386,301 @@ class Player(Mobile):
 		return bp
 
 
+class SkillTable:
+	''' The player's skills, stored in columns indexed by skill id (0 based)
+
+	Values are in tenths. A full skill list replaces the columns, single
+	skill updates patch them in place.
+	'''
+
+	## Initial number of skills, grows when needed
+	SIZE = 64
+
+	# Constants for lock
+	LOCK_UP = 0
+	LOCK_DOWN = 1
+	LOCK_LOCKED = 2
+
+	## A single skill, as returned by get()
+	Skill = collections.namedtuple('Skill', ('id', 'value', 'base', 'lock', 'cap'))
+
+	def __init__(self):
+		## Current values, in tenths
+		self.value = array.array('H', [0]) * self.SIZE
+		## Base values, in tenths
+		self.base = array.array('H', [0]) * self.SIZE
+		## Lock status, see LOCK_ constants
+		self.lock = array.array('B', [0]) * self.SIZE
+		## Caps, in tenths, 0 when unknown
+		self.cap = array.array('H', [0]) * self.SIZE
+		## Number of skills in the last full list, 0 if not received yet
+		self.count = 0
+
+	def update(self, pkt):
+		'''! Updates the table from a skills packet
+		@param pkt SendSkillsPacket
+		'''
+		if not pkt.skills:
+			return
+		columns = list(zip(*pkt.skills))
+		ids = columns[0]
+		if pkt.isFull():
+			# Full lists use 1 based ids
+			ids = [id - 1 for id in ids]
+			self.count = len(ids)
+		if max(ids) >= len(self.value):
+			self.grow(max(ids) + 1)
+
+		if ids[0] == 0 and ids[-1] == len(ids) - 1:
+			# Usual full list, all skills in order: replace whole columns
+			self.value[:len(ids)] = array.array('H', columns[1])
+			self.base[:len(ids)] = array.array('H', columns[2])
+			self.lock[:len(ids)] = array.array('B', columns[3])
+			if len(columns) > 4:
+				self.cap[:len(ids)] = array.array('H', columns[4])
+			return
+
+		for i, id in enumerate(ids):
+			self.value[id] = columns[1][i]
+			self.base[id] = columns[2][i]
+			self.lock[id] = columns[3][i]
+			if len(columns) > 4:
+				self.cap[id] = columns[4][i]
+
+	def grow(self, size):
+		''' Extends all the columns to the given size, internal usage '''
+		for column in (self.value, self.base, self.lock, self.cap):
+			column.extend([0] * (size - len(column)))
+
+	def get(self, id):
+		'''! Returns a single skill
+		@param id int: The skill id, 0 based
+		@return Skill
+		'''
+		return self.Skill(id, self.value[id], self.base[id], self.lock[id], self.cap[id])
+
+
+class SpatialIndex:
+	''' Uniform grid over the positions of the objects in the world
+
+	Only objects lying in the world are indexed, not the ones inside containers
+	or equipped. Distances are measured in tiles, as the largest of the X and Y
+	distances (like the server does for ranges).
+
+	Changed by the client thread only, queries from other threads copy every
+	cell before reading it.
+	'''
+
+	## Side of a grid cell, in tiles
+	CELL = 16
+
+	def __init__(self):
+		## Sets of objects by cell coordinates (x // CELL, y // CELL)
+		self.cells = {}
+		## Cell and object by serial, internal usage
+		self.placed = {}
+
+	def place(self, obj):
+		''' Adds the object to the index or moves it to its current position '''
+		key = (obj.x // self.CELL, obj.y // self.CELL)
+		old = self.placed.get(obj.serial)
+		if old is not None:
+			if old[0] == key and old[1] is obj:
+				return
+			self.remove(obj.serial)
+		cell = self.cells.get(key)
+		if cell is None:
+			cell = self.cells[key] = set()
+		cell.add(obj)
+		self.placed[obj.serial] = (key, obj)
+
+	def remove(self, serial):
+		''' Removes the object with the given serial, if indexed '''
+		old = self.placed.pop(serial, None)
+		if old is None:
+			return
+		key, obj = old
+		cell = self.cells[key]
+		cell.discard(obj)
+		if not cell:
+			del self.cells[key]
+
+	def inRange(self, x, y, r):
+		'''! Iterates over the objects within the given range
+		@param r int: Range in tiles, 0 = only the given tile
+		'''
+		cells = self.cells
+		size = self.CELL
+		for cx in range((x - r) // size, (x + r) // size + 1):
+			for cy in range((y - r) // size, (y + r) // size + 1):
+				cell = cells.get((cx, cy))
+				if cell is None:
+					continue
+				for obj in list(cell):
+					if abs(obj.x - x) <= r and abs(obj.y - y) <= r:
+						yield obj
+
+	def nearest(self, x, y, filter=None, maxRange=None):
+		'''! Finds the nearest object, visiting the cells in rings of growing distance
+		@param filter callable: If given, only objects for which it returns True are considered
+		@param maxRange int: If given, don't look farther than this range
+		@return The object, None if not found
+		'''
+		cells = self.cells
+		size = self.CELL
+		ccx = x // size
+		ccy = y // size
+		best = None
+		bestDist = None
+		seen = 0
+		ring = 0
+		while seen < len(cells):
+			if maxRange is not None and (ring - 1) * size >= maxRange:
+				break
+			if ring:
+				keys = [(cx, cy) for cx in range(ccx - ring, ccx + ring + 1)
+						for cy in (ccy - ring, ccy + ring)]
+				keys.extend([(cx, cy) for cx in (ccx - ring, ccx + ring)
+						for cy in range(ccy - ring + 1, ccy + ring)])
+			else:
+				keys = ((ccx, ccy), )
+			for key in keys:
+				cell = cells.get(key)
+				if cell is None:
+					continue
+				seen += 1
+				for obj in list(cell):
+					dist = max(abs(obj.x - x), abs(obj.y - y))
+					if bestDist is not None and dist >= bestDist:
+						continue
+					if maxRange is not None and dist > maxRange:
+						continue
+					if filter is None or filter(obj):
+						best = obj
+						bestDist = dist
+			# Next ring is at least ring * CELL + 1 tiles away
+			if bestDist is not None and bestDist <= ring * size:
+				break
+			ring += 1
+		return best
+
+	def __len__(self):
+		return len(self.placed)
+
+
+class ObjectIndex:
+	''' Secondary indexes over the known objects: by class, graphic, container and notoriety
+
+	Every index maps a key to the set of the matching objects. An object is
+	indexed under its class and all its UOBject base classes, so Item also
+	finds the containers.
+	'''
+
+	def __init__(self):
+		## Sets of objects by class
+		self.byClass = {}
+		## Sets of objects by graphic ID
+		self.byGraphic = {}
+		## Sets of items by serial of the container or mobile holding them
+		self.byContainer = {}
+		## Sets of mobiles by notoriety
+		self.byNotoriety = {}
+		## Indexed keys and object by serial, internal usage
+		self.indexed = {}
+
+	@staticmethod
+	def keys(obj):
+		''' Returns the keys of the object in every index, internal usage '''
+		return (obj.__class__, obj.graphic, getattr(obj, 'container', None),
+				getattr(obj, 'notoriety', None))
+
+	def update(self, obj):
+		''' Adds the object to the indexes or moves it after a change '''
+		keys = self.keys(obj)
+		old = self.indexed.get(obj.serial)
+		if old is not None:
+			if old[0] == keys and old[1] is obj:
+				return
+			self.remove(obj.serial)
+		cls, graphic, container, notoriety = keys
+		for base in cls.__mro__:
+			if issubclass(base, UOBject):
+				self.add(self.byClass, base, obj)
+		self.add(self.byGraphic, graphic, obj)
+		self.add(self.byContainer, container, obj)
+		self.add(self.byNotoriety, notoriety, obj)
+		self.indexed[obj.serial] = (keys, obj)
+
+	def remove(self, serial):
+		''' Removes the object with the given serial, if indexed '''
+		old = self.indexed.pop(serial, None)
+		if old is None:
+			return
+		(cls, graphic, container, notoriety), obj = old
+		for base in cls.__mro__:
+			if issubclass(base, UOBject):
+				self.discard(self.byClass, base, obj)
+		self.discard(self.byGraphic, graphic, obj)
+		self.discard(self.byContainer, container, obj)
+		self.discard(self.byNotoriety, notoriety, obj)
+
+	@staticmethod
+	def add(index, key, obj):
+		''' Adds obj to the set of key, None keys are not indexed, internal usage '''
+		if key is None:
+			return
+		objs = index.get(key)
+		if objs is None:
+			objs = index[key] = set()
+		objs.add(obj)
+
+	@staticmethod
+	def discard(index, key, obj):
+		''' Removes obj from the set of key, internal usage '''
+		if key is None:
+			return
+		objs = index[key]
+		objs.discard(obj)
+		if not objs:
+			del index[key]
+
+	def find(self, cls=None, graphic=None, container=None, notoriety=None):
+		'''! Returns the objects matching all the given criteria
+
+		Scans only the smallest of the sets selected by the criteria.
+
+		@param cls type: Class of the objects, like Mobile
+		@param graphic int: Graphic ID
+		@param container int: Serial of the container or mobile holding the items
+		@param notoriety int: Notoriety of the mobiles
+		@return list
+		'''
+		criteria = []
+		if cls is not None:
+			criteria.append((self.byClass, cls, lambda o: isinstance(o, cls)))
+		if graphic is not None:
+			criteria.append((self.byGraphic, graphic, lambda o: o.graphic == graphic))
+		if container is not None:
+			criteria.append((self.byContainer, container,
+					lambda o: getattr(o, 'container', None) == container))
+		if notoriety is not None:
+			criteria.append((self.byNotoriety, notoriety,
+					lambda o: getattr(o, 'notoriety', None) == notoriety))
+		if not criteria:
+			return [obj for keys, obj in list(self.indexed.values())]
+
+		sets = [(index.get(key, ()), check) for index, key, check in criteria]
+		sets.sort(key=lambda s: len(s[0]))
+		# Copy first, the client thread may change the set meanwhile
+		objs = list(sets[0][0])
+		for check in [s[1] for s in sets[1:]]:
+			objs = [o for o in objs if check(o)]
+		return objs
+
+	def __len__(self):
+		return len(self.indexed)
+
+
 class Target:
 	''' Represents an active target '''
 
@@ -472,10 +822,55 @@ class Client(threading.Thread):
 
 	## Minimum interval between two pings
 	PING_INTERVAL = 30
+	## Maximum time the main loop waits idle, before checking if brain is alive
+	IDLE_INTERVAL = 1
 	## Version sent to server
 	VERSION = '5.0.9.1'
 	## Language sent to server
 	LANG = 'ENU'
+	## Interval between the warnings logged by waitFor() when waiting with no timeout
+	WAIT_WARN_INTERVAL = 5
+	## Packets ignored by handlePacket(), default for the skip policy
+	IGNORED_PACKETS = (
+		packets.ControlAnimationPacket,
+		packets.GraphicalEffectPacket,
+		packets.PlaySoundPacket,
+		packets.SetWeatherPacket,
+		packets.OverallLightLevelPacket,
+		packets.SeasonInfoPacket,
+	)
+	## Name of the default handler method for every packet type, see registerHandler()
+	HANDLERS = {
+		packets.LoginDeniedPacket: 'handleLoginDeniedPacket',
+		packets.PingPacket: 'handlePingPacket',
+		packets.Unk32Packet: 'handleUnk32Packet',
+		packets.CharLocaleBodyPacket: 'handleCharLocaleBodyPacket',
+		packets.LoginCompletePacket: 'handleLoginCompletePacket',
+		packets.DrawGamePlayerPacket: 'handleDrawGamePlayerPacket',
+		packets.DrawObjectPacket: 'handleDrawObjectPacket',
+		packets.ObjectInfoPacket: 'handleObjectInfoPacket',
+		packets.UpdatePlayerPacket: 'handleUpdatePlayerPacket',
+		packets.DeleteObjectPacket: 'handleDeleteObjectPacket',
+		packets.DrawContainerPacket: 'handleDrawContainerPacket',
+		packets.AddItemToContainerPacket: 'handleAddItemToContainerPacket',
+		packets.AddItemsToContainerPacket: 'handleAddItemsToContainerPacket',
+		packets.CharacterAnimationPacket: 'handleCharacterAnimationPacket',
+		packets.WarModePacket: 'handleWarModePacket',
+		packets.AllowAttackPacket: 'handleAllowAttackPacket',
+		packets.UpdateHealthPacket: 'handleUpdateHealthPacket',
+		packets.UpdateManaPacket: 'handleUpdateManaPacket',
+		packets.UpdateStaminaPacket: 'handleUpdateStaminaPacket',
+		packets.SendSkillsPacket: 'handleSendSkillsPacket',
+		packets.GeneralInfoPacket: 'handleGeneralInfoPacket',
+		packets.TipWindowPacket: 'handleTipWindowPacket',
+		packets.SendSpeechPacket: 'handleSpeechPacket',
+		packets.UnicodeSpeechPacket: 'handleSpeechPacket',
+		packets.TargetCursorPacket: 'handleTargetCursorPacket',
+		packets.SendGumpDialogPacket: 'handleGumpPacket',
+		packets.CompressedGumpPacket: 'handleGumpPacket',
+		packets.MoveAckPacket: 'handleMovePacket',
+		packets.MoveRejectPacket: 'handleMovePacket',
+	}
 
 	def __init__(self):
 		super().__init__()
@@ -486,9 +881,27 @@ class Client(threading.Thread):
 		self.sendqueue = []
 		## Lock for the send queue
 		self.sendqueueLock = threading.Lock()
+		## Socket pair used to wake up the main loop when something is queued, internal usage
+		## Only open while the main loop runs
+		self.wakeupRecv = None
+		self.wakeupSend = None
 
 		## Dict info about last server connected to {ip, port, user, pass}
 		self.server = None
+		## Network connection, None until connected
+		self.net = None
+		## IDs of the packets received but never decoded, change before connecting
+		self.skip = frozenset([p.cmd for p in self.IGNORED_PACKETS])
+		## Packet handlers by packet ID, see registerHandler()
+		self.handlers = {}
+		for cls in self.IGNORED_PACKETS:
+			self.handlers[cls.cmd] = self.handleIgnoredPacket
+		for cls, name in self.HANDLERS.items():
+			self.handlers[cls.cmd] = getattr(self, name)
+		## Wether to decode the received packets only when their fields are accessed
+		self.lazy = False
+		## Binary file where all the received data is recorded, see Network.record
+		self.record = None
 		## Current client status, one of:
 		## - disconnected: The client is not connected
 		## - connected: Connected and logged in, server not selected
@@ -512,13 +925,23 @@ class Client(threading.Thread):
 		self.moveLock = threading.Lock()
 		## Unacknowledged moves
 		self.unmoves = collections.deque()
+		## Condition notified when the client's state changes, see waitFor()
+		self.changed = threading.Condition()
 
 		## Reference to player, character instance
 		self.player = None
 		## Dictionary of Objects (Mobiles and Items) around, by serial
 		self.objects = {}
+		## Positions of the objects lying in the world, see objectsInRange() and nearest()
+		self.grid = SpatialIndex()
+		## Indexes of the objects by class, graphic, container and notoriety, see findObjects()
+		self.index = ObjectIndex()
 		## Reference to current active target, if any
 		self.target = None
+		## Player's skills
+		self.skills = SkillTable()
+		## Open gumps, by gump type ID
+		self.gumps = {}
 
 		## Current Realm's width
 		self.width = None
@@ -553,7 +976,7 @@ class Client(threading.Thread):
 		}
 
 		self.log.info('connecting')
-		self.net = net.Network(self.server['ip'], self.server['port'])
+		self.openNetwork(self.server['ip'], self.server['port'])
 
 		# Send IP as key (will not use encryption)
 		self.queue(ipaddress.ip_address(self.server['ip']).packed)
@@ -578,6 +1001,13 @@ class Client(threading.Thread):
 		self.status = 'connected'
 		return pkt.servers
 
+	def openNetwork(self, ip, port):
+		''' Connects to the given server, applying the decoding policy, internal usage '''
+		self.net = net.Network(ip, port)
+		self.net.skip = self.skip
+		self.net.lazy = self.lazy
+		self.net.record = self.record
+
 	@status('connected')
 	def selectServer(self, idx):
 		''' Selects the game server with the given idx '''
@@ -591,7 +1021,7 @@ class Client(threading.Thread):
 
 		# Connect
 		self.net.close()
-		self.net = net.Network(ip, pkt.port)
+		self.openNetwork(ip, pkt.port)
 
 		# Send key
 		bkey = struct.pack('>I', pkt.key)
@@ -649,7 +1079,7 @@ class Client(threading.Thread):
 			type, value, tb = sys.exc_info()
 			msg = ''.join(traceback.format_exception(type, value, tb))
 			self.log.critical(msg)
-			self.brain.event(brain.Event(brain.Event.EVT_CLIENT_CRASH, exception=e))
+			self.brain.event(brain.ClientCrashEvent(e))
 
 	@status('game')
 	@clientthread
@@ -657,176 +1087,208 @@ class Client(threading.Thread):
 		''' Starts the endless game loop '''
 		self.ping = time.time() + self.PING_INTERVAL
 
-		while True:
-			pkt = self.receive(blocking=False)
-			self.send()
-
-			# Check if brain is alive
-			if not threading.main_thread().is_alive():
-				self.log.info("Brain died, terminating")
-				break
-
-			# Send ping if needed
-			if self.lc and self.ping < time.time():
-				po = packets.PingPacket()
-				po.fill(0)
-				self.queue(po)
-				self.ping = time.time() + self.PING_INTERVAL
-
-			# Process packet
-			if pkt is None:
-				time.sleep(0.01)
-			else:
-				self.handlePacket(pkt)
+		self.wakeupRecv, self.wakeupSend = socket.socketpair()
+		self.wakeupRecv.setblocking(False)
+		self.wakeupSend.setblocking(False)
+		try:
+			# Used to wait for incoming data or queued packets to send
+			with selectors.DefaultSelector() as selector:
+				selector.register(self.net, selectors.EVENT_READ)
+				selector.register(self.wakeupRecv, selectors.EVENT_READ)
+				while True:
+					# Get all the packets already arrived at once
+					pkts = self.net.recvMany(blocking=False)
+					self.send()
+
+					# Check if brain is alive
+					if not threading.main_thread().is_alive():
+						self.log.info("Brain died, terminating")
+						break
+
+					# Send ping if needed
+					if self.lc and self.ping < time.time():
+						po = packets.PingPacket()
+						po.fill(0)
+						self.queue(po)
+						self.ping = time.time() + self.PING_INTERVAL
+
+					# Process packets, then let the waiting threads check the new state
+					for pkt in pkts:
+						self.handlePacket(pkt)
+					if pkts:
+						self.notifyChanged()
+
+					# Nothing to do, wait for data or for next ping
+					if not pkts:
+						timeout = self.IDLE_INTERVAL
+						if self.lc:
+							timeout = max(0, min(timeout, self.ping - time.time()))
+						selector.select(timeout)
+						try:
+							while self.wakeupRecv.recv(4096):
+								pass
+						except BlockingIOError:
+							pass
+		finally:
+			wakeupRecv, wakeupSend = self.wakeupRecv, self.wakeupSend
+			self.wakeupRecv = self.wakeupSend = None
+			wakeupRecv.close()
+			wakeupSend.close()
 
 	@status('game')
 	@clientthread
 	def handlePacket(self, pkt):
-		''' Handles an incoming packet '''
-
-		if isinstance(pkt, packets.LoginDeniedPacket):
-			self.log.error('login denied')
-			raise LoginDeniedError(pkt.reason)
-
-		elif isinstance(pkt, packets.PingPacket):
-			self.log.debug("Server sent a ping back")
-
-		elif isinstance(pkt, packets.CharLocaleBodyPacket):
-			self.handleCharLocaleBodyPacket(pkt)
-
-		elif isinstance(pkt, packets.DrawGamePlayerPacket):
-			self.handleDrawGamePlayerPacket(pkt)
-
-		elif isinstance(pkt, packets.DrawObjectPacket):
-			self.handleDrawObjectPacket(pkt)
+		''' Handles an incoming packet, dispatching it by ID '''
+		handler = self.handlers.get(pkt.cmd)
+		if handler is None:
+			self.log.warn("Unhandled packet {}".format(pkt.__class__))
+		else:
+			handler(pkt)
 
-		elif isinstance(pkt, packets.ObjectInfoPacket):
-			self.handleObjectInfoPacket(pkt)
+	def registerHandler(self, packet, handler):
+		'''! Sets the handler for a packet type, replacing the current one
 
-		elif isinstance(pkt, packets.UpdatePlayerPacket):
-			assert self.lc
-			self.objects[pkt.serial].update(pkt)
-			self.log.info("Updated mobile: %s", self.objects[pkt.serial])
+		The handler is called from the client thread with the packet as only
+		argument. To extend the default behavior, call the returned handler.
+		Packets skipped by default (see IGNORED_PACKETS) are decoded again from
+		now on, so the handler gets all their fields.
 
-		elif isinstance(pkt, packets.DeleteObjectPacket):
-			assert self.lc
-			if pkt.serial in self.objects:
-				del self.objects[pkt.serial]
-				self.log.info("Object 0x%X went out of sight", pkt.serial)
-			else:
-				self.log.warn("Server requested to delete 0x%X but i don't know it", pkt.serial)
+		@param packet Packet class or int: The packet type or ID
+		@param handler callable: The new handler, None to leave the packet unhandled
+		@return The previous handler, None if there was none
+		'''
+		cmd = packet if isinstance(packet, int) else packet.cmd
+		old = self.handlers.get(cmd)
+		if handler is None:
+			self.handlers.pop(cmd, None)
+		else:
+			self.handlers[cmd] = handler
+			if cmd in self.skip:
+				self.skip = self.skip - frozenset([cmd])
+				if self.net is not None:
+					self.net.skip = self.skip
+		return old
+
+	def handleIgnoredPacket(self, pkt):
+		self.log.info('Ignoring %s', pkt.__class__.__name__)
+
+	def handleLoginDeniedPacket(self, pkt):
+		self.log.error('login denied')
+		raise LoginDeniedError(pkt.reason)
+
+	def handlePingPacket(self, pkt):
+		self.log.debug("Server sent a ping back")
+
+	def handleUnk32Packet(self, pkt):
+		self.log.warn("Unknown 0x32 packet received")
+
+	def handleUpdatePlayerPacket(self, pkt):
+		assert self.lc
+		self.objects[pkt.serial].update(pkt)
+		self.placeObject(self.objects[pkt.serial])
+		self.log.info("Updated mobile: %s", self.objects[pkt.serial])
+
+	def handleDeleteObjectPacket(self, pkt):
+		assert self.lc
+		if pkt.serial in self.objects:
+			del self.objects[pkt.serial]
+			self.grid.remove(pkt.serial)
+			self.index.remove(pkt.serial)
+			self.log.info("Object 0x%X went out of sight", pkt.serial)
+		else:
+			self.log.warn("Server requested to delete 0x%X but i don't know it", pkt.serial)
 
-		elif isinstance(pkt, packets.AddItemToContainerPacket):
-			assert self.lc
-			if isinstance(self.objects[pkt.container], Container):
-				self.objects[pkt.container].addItem(pkt)
+	def handleAddItemToContainerPacket(self, pkt):
+		assert self.lc
+		if isinstance(self.objects[pkt.container], Container):
+			self.objects[pkt.container].addItem(pkt)
+		else:
+			self.log.warn("Ignoring add item 0x%X to non-container 0x%X", pkt.serial, pkt.container)
+
+	def handleAddItemsToContainerPacket(self, pkt):
+		assert self.lc
+		# Items usually all go in the same container, add them in bulk
+		for serial, items in itertools.groupby(pkt.items, operator.attrgetter('container')):
+			if isinstance(self.objects[serial], Container):
+				self.objects[serial].addItems(items)
 			else:
-				self.log.warn("Ignoring add item 0x%X to non-container 0x%X", pkt.serial, pkt.container)
-
-		elif isinstance(pkt, packets.AddItemsToContainerPacket):
-			assert self.lc
-			for it in pkt.items:
-				if isinstance(self.objects[it['container']], Container):
-					self.objects[it['container']].addItem(it)
-				else:
-					self.log.warn("Ignoring add item 0x%X to non-container 0x%X", it['serial'], it['container'])
-
-		elif isinstance(pkt, packets.WarModePacket):
-			assert self.player.war is None
-			self.player.war = pkt.war
-
-		elif isinstance(pkt, packets.AllowAttackPacket):
-			assert self.lc
-			self.player.target = pkt.serial
-			self.log.info("Target set to 0x%X", self.player.target)
-
-		elif isinstance(pkt, packets.UpdateHealthPacket):
-			self.handleUpdateVitalPacket(pkt, 'hp', 'maxhp', brain.Event.EVT_HP_CHANGED)
-
-		elif isinstance(pkt, packets.UpdateManaPacket):
-			self.handleUpdateVitalPacket(pkt, 'mana', 'maxmana', brain.Event.EVT_MANA_CHANGED)
-
-		elif isinstance(pkt, packets.UpdateStaminaPacket):
-			self.handleUpdateVitalPacket(pkt, 'stam', 'maxstam', brain.Event.EVT_STAM_CHANGED)
-
-		elif isinstance(pkt, packets.GeneralInfoPacket):
-			self.handleGeneralInfoPacket(pkt)
-
-		elif isinstance(pkt, packets.DrawContainerPacket):
-			cont = self.objects[pkt.serial]
-			assert isinstance(cont, Item)
-			if not isinstance(cont, Container):
-				# Upgrade the item to a Container
-				cont.upgradeToContainer()
+				for it in items:
+					self.log.warn("Ignoring add item 0x%X to non-container 0x%X", it.serial, it.container)
+
+	def handleDrawContainerPacket(self, pkt):
+		cont = self.objects[pkt.serial]
+		assert isinstance(cont, Item)
+		if not isinstance(cont, Container):
+			# Upgrade the item to a Container
+			cont.upgradeToContainer()
+			self.index.update(cont)
+
+	def handleCharacterAnimationPacket(self, pkt):
+		assert self.lc
+		# Just check that the object exists
+		self.objects[pkt.serial]
+
+	def handleWarModePacket(self, pkt):
+		assert self.player.war is None
+		self.player.war = pkt.war
+
+	def handleAllowAttackPacket(self, pkt):
+		assert self.lc
+		self.player.target = pkt.serial
+		self.log.info("Target set to 0x%X", self.player.target)
+
+	def handleUpdateHealthPacket(self, pkt):
+		self.handleUpdateVitalPacket(pkt, 'hp', 'maxhp', brain.HpChangedEvent)
+
+	def handleUpdateManaPacket(self, pkt):
+		self.handleUpdateVitalPacket(pkt, 'mana', 'maxmana', brain.ManaChangedEvent)
+
+	def handleUpdateStaminaPacket(self, pkt):
+		self.handleUpdateVitalPacket(pkt, 'stam', 'maxstam', brain.StamChangedEvent)
+
+	def handleSendSkillsPacket(self, pkt):
+		self.skills.update(pkt)
+
+	def handleTipWindowPacket(self, pkt):
+		assert self.lc
+		self.log.info("Received tip: %s", pkt.msg.replace('\r','\n'))
+
+	def handleSpeechPacket(self, pkt):
+		speech = Speech(self, pkt)
+		if self.lc:
+			self.log.info(repr(speech))
+		else:
+			self.log.warn('EARLY %s', repr(speech))
+		self.brain.event(brain.SpeechEvent(speech))
 
-		elif isinstance(pkt, packets.TipWindowPacket):
-			assert self.lc
-			self.log.info("Received tip: %s", pkt.msg.replace('\r','\n'))
+	def handleTargetCursorPacket(self, pkt):
+		assert self.target is None
+		self.target = Target(self, pkt)
 
-		elif isinstance(pkt, packets.SendSpeechPacket) or isinstance(pkt, packets.UnicodeSpeechPacket):
-			speech = Speech(self, pkt)
-			if self.lc:
-				self.log.info(repr(speech))
-			else:
-				self.log.warn('EARLY %s', repr(speech))
-			self.brain.event(brain.Event(brain.Event.EVT_SPEECH, speech=speech))
-
-		elif isinstance(pkt, packets.TargetCursorPacket):
-			assert self.target is None
-			self.target = Target(self, pkt)
-
-		elif isinstance(pkt, packets.CharacterAnimationPacket):
-			assert self.lc
-			# Just check that the object exists
-			self.objects[pkt.serial]
-
-		elif isinstance(pkt, packets.LoginCompletePacket):
-			assert not self.lc
-			assert self.player is not None
-			self.lc = True
-			# Send some initial info packets      ..
-			self.requestSkills()
-			self.sendVersion()
-			# Original client also sends this now
-			# bf 00 0d 00 05 00 00 03 20 01 00 00 a7 - General info 0x05
-			self.sendClientType()
-			# Original client also sends this now, seems to also send it again later
-			# 34 ed ed ed ed 04 00 45 dd f5 - Get Player status something
-			self.sendLanguage()
-			self.singleClick(self.player)
-
-			# Start the brain
-			self.brain.started.set()
-
-		elif isinstance(pkt, packets.MoveAckPacket) or isinstance(pkt, packets.MoveRejectPacket):
-			self.handleMovePacket(pkt)
-
-		elif isinstance(pkt, packets.Unk32Packet):
-			self.log.warn("Unknown 0x32 packet received")
-
-		elif isinstance(pkt, packets.ControlAnimationPacket):
-			assert self.lc
-			self.log.info('Ignoring animation packet')
-
-		elif isinstance(pkt, packets.GraphicalEffectPacket):
-			assert self.lc
-			self.log.info('Graphical effect packet')
-
-		elif isinstance(pkt, packets.PlaySoundPacket):
-			assert self.lc
-			self.log.info('Ignoring sound packet')
-
-		elif isinstance(pkt, packets.SetWeatherPacket):
-			self.log.info('Ignoring weather packet')
-
-		elif isinstance(pkt, packets.OverallLightLevelPacket):
-			self.log.info('Ignoring light level packet')
-
-		elif isinstance(pkt, packets.SeasonInfoPacket):
-			self.log.info('Ignoring season packet')
+	def handleGumpPacket(self, pkt):
+		# Layout is parsed only if somebody reads it
+		gmp = gump.Gump(pkt)
+		self.log.info('New %s', gmp)
+		self.gumps[gmp.gumpid] = gmp
+		self.brain.event(brain.GumpEvent(gmp))
 
-		else:
-			self.log.warn("Unhandled packet {}".format(pkt.__class__))
+	def handleLoginCompletePacket(self, pkt):
+		assert not self.lc
+		assert self.player is not None
+		self.lc = True
+		# Send some initial info packets      ..
+		self.requestSkills()
+		self.sendVersion()
+		# Original client also sends this now
+		# bf 00 0d 00 05 00 00 03 20 01 00 00 a7 - General info 0x05
+		self.sendClientType()
+		# Original client also sends this now, seems to also send it again later
+		# 34 ed ed ed ed 04 00 45 dd f5 - Get Player status something
+		self.sendLanguage()
+		self.singleClick(self.player)
+
+		# Start the brain
+		self.brain.started.set()
 
 	@status('game')
 	@clientthread
@@ -855,6 +1317,7 @@ class Client(threading.Thread):
 
 		assert self.player.serial not in self.objects.keys()
 		self.objects[self.player.serial] = self.player
+		self.placeObject(self.player)
 
 		self.log.info("Realm size: %d,%d", self.width, self.height)
 		self.log.info("You are 0x%X and your graphic is 0x%X", self.player.serial, self.player.graphic)
@@ -881,12 +1344,14 @@ class Client(threading.Thread):
 	def handleDrawObjectPacket(self, pkt):
 		if pkt.serial in self.objects.keys():
 			self.objects[pkt.serial].update(pkt)
+			self.placeObject(self.objects[pkt.serial])
 			self.log.info("Refreshed mobile: %s", self.objects[pkt.serial])
 		else:
 			mob = Mobile(self, pkt)
 			self.objects[mob.serial] = mob
+			self.placeObject(mob)
 			self.log.info("New mobile: %s", mob)
-			self.brain.event(brain.Event(brain.Event.EVT_NEW_MOBILE, mobile=mob))
+			self.brain.event(brain.NewMobileEvent(mob))
 			# Auto single click for new mobiles
 			self.singleClick(mob)
 
@@ -896,16 +1361,18 @@ class Client(threading.Thread):
 	def handleObjectInfoPacket(self, pkt):
 		if pkt.serial in self.objects.keys():
 			self.objects[pkt.serial].update(pkt)
+			self.placeObject(self.objects[pkt.serial])
 			self.log.info("Refresh item: %s", self.objects[pkt.serial])
 		else:
 			item = Item(self, pkt)
 			self.log.info("New item: %s", item)
 			self.objects[item.serial] = item
+			self.placeObject(item)
 
 	@status('game')
 	@clientthread
 	@logincomplete
-	def handleUpdateVitalPacket(self, pkt, attrName, maxAttrName, eventId):
+	def handleUpdateVitalPacket(self, pkt, attrName, maxAttrName, eventClass):
 		old = getattr(self.player, attrName)
 		if self.player.serial == pkt.serial:
 			setattr(self.player, maxAttrName, pkt.max)
@@ -917,7 +1384,7 @@ class Client(threading.Thread):
 			setattr(mob, attrName, pkt.cur)
 			self.log.info("0x%X's %s: %d/%d", pkt.serial, attrName.upper(), pkt.cur, pkt.max)
 		cur = getattr(self.player, attrName)
-		self.brain.event(brain.Event(eventId, old=old, new=cur))
+		self.brain.event(eventClass(old, cur))
 
 	@status('game')
 	@clientthread
@@ -928,6 +1395,9 @@ class Client(threading.Thread):
 			pass
 		elif pkt.sub == packets.GeneralInfoPacket.SUB_PARTY:
 			self.log.info("Ignoring party system data")
+		elif pkt.sub == packets.GeneralInfoPacket.SUB_CLOSEGUMP:
+			if self.gumps.pop(pkt.gumpid, None) is not None:
+				self.log.info("Server closed gump 0x%X", pkt.gumpid)
 		else:
 			self.log.warn("Unhandled GeneralInfo subpacket 0x%X", pkt.sub)
 
@@ -989,17 +1459,16 @@ class Client(threading.Thread):
 			self.player.z = pkt.z
 			self.player.facing = pkt.direction
 
-		self.brain.event(brain.Event(brain.Event.EVT_MOVED,
-				oldx=oldx, oldy=oldy, oldz=oldz, oldfacing=oldfacing,
-				x=self.player.x, y=self.player.y, z=self.player.z,
-				facing=self.player.facing, ack=ack))
+		self.grid.place(self.player)
+		self.brain.event(brain.MovedEvent(oldx, oldy, oldz, oldfacing,
+				self.player.x, self.player.y, self.player.z, self.player.facing, ack))
 
 		# Handle the notoriety
 		if ack and self.player.notoriety != pkt.notoriety:
 			old = self.player.notoriety
 			self.player.notoriety = pkt.notoriety
-			self.brain.event(brain.Event(brain.Event.EVT_NOTORIETY,
-					old=old, new=self.player.notoriety))
+			self.index.update(self.player)
+			self.brain.event(brain.NotorietyEvent(old, self.player.notoriety))
 
 	@logincomplete
 	def sendVersion(self):
@@ -1084,6 +1553,62 @@ class Client(threading.Thread):
 			self.unmoves.append(po)
 			self.queue(po)
 
+	@logincomplete
+	def respondGump(self, gmp, buttonid=0, switches=None, texts=None):
+		'''! Replies to the given gump, which is then closed
+		@param gmp Gump: The gump to reply to
+		@param buttonid int: ID of the pressed reply button, 0 to just close the gump
+		@param switches list of int: IDs of the checked switches, None to keep the initial state
+		@param texts dict: Content of text entries by ID, the missing ones keep the initial content
+		@throws ValueError if an ID is not in the gump
+		'''
+		po = gmp.response(buttonid, switches, texts)
+		if self.gumps.get(gmp.gumpid) is gmp:
+			del self.gumps[gmp.gumpid]
+		self.queue(po)
+
+	def placeObject(self, obj):
+		''' Updates the indexes of an object lying in the world, internal usage '''
+		self.grid.place(obj)
+		self.index.update(obj)
+
+	def findObjects(self, cls=None, graphic=None, container=None, notoriety=None):
+		'''! Returns the known objects matching all the given criteria, see ObjectIndex.find()
+		@param cls type: Class of the objects, like Mobile
+		@param graphic int: Graphic ID
+		@param container int: Serial of the container or mobile holding the items
+		@param notoriety int: Notoriety of the mobiles
+		@return list
+		'''
+		return self.index.find(cls, graphic, container, notoriety)
+
+	def objectsInRange(self, x, y, r, cls=None, notoriety=None):
+		'''! Returns the objects lying in the world within the given range
+		@param r int: Range in tiles
+		@param cls type: If given, only return instances of this class, like Mobile
+		@param notoriety int: If given, only return mobiles with this notoriety
+		@return list
+		'''
+		objs = self.grid.inRange(x, y, r)
+		if cls is not None:
+			objs = [o for o in objs if isinstance(o, cls)]
+		if notoriety is not None:
+			objs = [o for o in objs if getattr(o, 'notoriety', None) == notoriety]
+		return list(objs)
+
+	def nearest(self, cls=None, filter=None, maxRange=None):
+		'''! Returns the object nearest to the player, the player excluded
+		@param cls type: If given, only consider instances of this class, like Mobile
+		@param filter callable: If given, only consider objects for which it returns True
+		@param maxRange int: If given, don't look farther than this range
+		@return The object, None if not found
+		'''
+		player = self.player
+		def accept(obj):
+			return obj is not player and (cls is None or isinstance(obj, cls)) \
+					and (filter is None or filter(obj))
+		return self.grid.nearest(player.x, player.y, accept, maxRange)
+
 	@logincomplete
 	def waitForTarget(self, timeout=None):
 		'''! Waits until a target cursor is requested and return it. If timeout is given, returns after timeout
@@ -1095,26 +1620,38 @@ class Client(threading.Thread):
 
 	def waitFor(self, cond, timeout=None):
 		'''! Utility function, waits until a condition is satisfied or until timeout expires
+
+		The condition is checked again every time the client notifies a change,
+		it must not be called from the client thread.
+
 		@return True when consition succeeds, False on timeout
 		'''
-		wait = 0.0
-		nextWarn = 5.0
-		while not cond():
-			time.sleep(0.01)
-			wait += 0.01
+		with self.changed:
 			if timeout:
-				if wait >= timeout:
-					return False
-			elif wait >= nextWarn:
+				return self.changed.wait_for(cond, timeout)
+			while not self.changed.wait_for(cond, self.WAIT_WARN_INTERVAL):
 				self.log.warn("Waiting for {}...".format(traceback.extract_stack(limit=2)[0]))
-				nextWarn = wait + 5.0
 		return True
 
+	def notifyChanged(self):
+		''' Wakes up the threads in waitFor(), call it after changing the client's state '''
+		with self.changed:
+			self.changed.notify_all()
+
 	def queue(self, data):
 		''' Puts a packet in the queue to be sent asap '''
 		with self.sendqueueLock:
 			self.sendqueue.append(data)
 
+		# Wake up the main loop, if waiting
+		wakeupSend = self.wakeupSend
+		if wakeupSend is not None and threading.current_thread() is not self:
+			try:
+				wakeupSend.send(b'\x00')
+			except OSError:
+				# Main loop has already been waken up or just terminated
+				pass
+
 	@clientthread
 	def send(self):
 		''' Sends all packets in the queue '''
@@ -1122,8 +1659,8 @@ class Client(threading.Thread):
 			queue = self.sendqueue
 			self.sendqueue = []
 
-		for data in queue:
-			self.net.send(data)
+		if queue:
+			self.net.sendMany(queue)
 
 	@clientthread
 	def receive(self, expect=None, blocking=True):
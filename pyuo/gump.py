@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+'''
+Gumps for Python Ultima Online text client
+Copyright (C) 2015-2016 Gabriele Tozzi
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+'''
+
+import re
+import struct
+import zlib
+import collections
+
+from . import packets
+
+
+################################################################################
+# Layout elements, every element tells the page it belongs to (0 = all pages)
+################################################################################
+
+
+class Element(collections.namedtuple('Element', ('page', 'name', 'args'))):
+	''' A layout command without a specific class, args are the raw strings '''
+
+	__slots__ = ()
+
+
+class Page(collections.namedtuple('Page', ('page', ))):
+	''' Start of a page, following elements belong to it '''
+
+	__slots__ = ()
+
+
+class Button(collections.namedtuple('Button',
+		('page', 'x', 'y', 'released', 'pressed', 'type', 'param', 'id'))):
+	''' A button, replies to the gump when type is REPLY, else goes to page param '''
+
+	__slots__ = ()
+
+	## Button types
+	PAGE = 0
+	REPLY = 1
+
+
+class Switch(collections.namedtuple('Switch',
+		('page', 'x', 'y', 'released', 'pressed', 'checked', 'id', 'radio'))):
+	''' A checkbox, or a radio button when radio is True '''
+
+	__slots__ = ()
+
+
+class TextEntry(collections.namedtuple('TextEntry',
+		('page', 'x', 'y', 'width', 'height', 'hue', 'id', 'text', 'limit'))):
+	''' An editable text field, text is the initial content, limit is None if unlimited '''
+
+	__slots__ = ()
+
+
+class Label(collections.namedtuple('Label', ('page', 'x', 'y', 'hue', 'text'))):
+	''' A static text '''
+
+	__slots__ = ()
+
+
+class Html(collections.namedtuple('Html',
+		('page', 'x', 'y', 'width', 'height', 'text', 'cliloc', 'background', 'scrollbar'))):
+	''' An HTML text box, showing either text or the cliloc message (the other is None) '''
+
+	__slots__ = ()
+
+
+################################################################################
+# The gump
+################################################################################
+
+
+class Gump:
+	''' A gump (dialog) received from the server
+
+	Layout and texts are kept as received: they are inflated, then the layout
+	is parsed into element tuples, only when first accessed. Everything is
+	cached, so the parsed form is shared by all the readers and by the replies.
+	'''
+
+	## Matches a single layout command
+	COMMAND_RE = re.compile(r'\{\s*([^}]*?)\s*\}')
+	## Length prefix of every text line in compressed gumps
+	USHORT = struct.Struct('>H')
+
+	def __init__(self, pkt):
+		'''! Builds the gump from the received packet, without parsing it
+		@param pkt SendGumpDialogPacket or CompressedGumpPacket
+		'''
+		## Gump's serial
+		self.serial = pkt.serial
+		## Gump's type ID
+		self.gumpid = pkt.gumpid
+		## Gump's X position
+		self.x = pkt.x
+		## Gump's Y position
+		self.y = pkt.y
+
+		if isinstance(pkt, packets.CompressedGumpPacket):
+			## Compressed layout and its inflated length, internal usage
+			self.packedLayout = (pkt.commandsData, pkt.commandsLength)
+			## Compressed texts, inflated length and number of lines, internal usage
+			self.packedTexts = (pkt.textsData, pkt.textsLength, pkt.textLines)
+			## Layout string, internal usage
+			self.layoutCache = None
+			## Texts list, internal usage
+			self.textsCache = None
+		else:
+			self.packedLayout = None
+			self.packedTexts = None
+			self.layoutCache = pkt.commands
+			self.textsCache = pkt.texts
+
+		## Parsed elements, internal usage
+		self.elementsCache = None
+		## Parsed elements grouped by class, internal usage
+		self.byClass = None
+
+	@property
+	def layout(self):
+		''' The layout commands string '''
+		if self.layoutCache is None:
+			data, length = self.packedLayout
+			self.layoutCache = packets.Packet.varStr(self.inflate(data, length))
+			self.packedLayout = None
+		return self.layoutCache
+
+	@property
+	def texts(self):
+		''' The list of text lines, referred by the layout '''
+		if self.textsCache is None:
+			data, length, lines = self.packedTexts
+			data = self.inflate(data, length)
+			texts = []
+			pos = 0
+			for i in range(lines):
+				end = pos + 2 + self.USHORT.unpack_from(data, pos)[0] * 2
+				texts.append(packets.Packet.varUStr(data[pos+2:end]))
+				pos = end
+			self.textsCache = texts
+			self.packedTexts = None
+		return self.textsCache
+
+	@property
+	def elements(self):
+		''' The list of all the layout elements, in layout order '''
+		if self.elementsCache is None:
+			self.elementsCache = self.parse()
+			self.byClass = collections.defaultdict(list)
+			for element in self.elementsCache:
+				self.byClass[element.__class__].append(element)
+		return self.elementsCache
+
+	def getElements(self, cls):
+		'''! Returns the elements of the given class
+		@param cls type: An element class, like Button
+		@return list
+		'''
+		self.elements # Parses the layout, if needed
+		return self.byClass.get(cls, [])
+
+	@property
+	def buttons(self):
+		''' List of Button elements '''
+		return self.getElements(Button)
+
+	@property
+	def switches(self):
+		''' List of Switch elements '''
+		return self.getElements(Switch)
+
+	@property
+	def textEntries(self):
+		''' List of TextEntry elements '''
+		return self.getElements(TextEntry)
+
+	@property
+	def pages(self):
+		''' List of Page elements '''
+		return self.getElements(Page)
+
+	def getButton(self, id):
+		'''! Returns the reply button with the given ID, None if not found '''
+		for button in self.buttons:
+			if button.type == Button.REPLY and button.id == id:
+				return button
+		return None
+
+	def response(self, buttonid, switches=None, texts=None):
+		'''! Builds the reply to this gump
+		@param buttonid int: ID of the pressed reply button, 0 to close the gump
+		@param switches list of int: IDs of the checked switches, None to keep the initial state
+		@param texts dict: Content of text entries by ID, the missing ones keep the initial content
+		@return GumpResponsePacket
+		@throws ValueError if an ID is not in the gump
+		'''
+		if buttonid and self.getButton(buttonid) is None:
+			raise ValueError('No reply button {} in gump 0x{:X}'.format(buttonid, self.gumpid))
+
+		if switches is None:
+			switches = [s.id for s in self.switches if s.checked]
+		else:
+			known = set([s.id for s in self.switches])
+			for id in switches:
+				if id not in known:
+					raise ValueError('No switch {} in gump 0x{:X}'.format(id, self.gumpid))
+
+		entries = {}
+		for entry in self.textEntries:
+			entries[entry.id] = entry.text
+		for id, text in (texts or {}).items():
+			if id not in entries:
+				raise ValueError('No text entry {} in gump 0x{:X}'.format(id, self.gumpid))
+			entries[id] = text
+
+		po = packets.GumpResponsePacket()
+		po.fill(self.serial, self.gumpid, buttonid, switches, entries)
+		return po
+
+	def parse(self):
+		''' Parses the layout into elements, internal usage '''
+		elements = []
+		page = 0
+		for match in self.COMMAND_RE.finditer(self.layout):
+			args = match.group(1).split()
+			if not args:
+				continue
+			name = args[0].lower()
+			args = args[1:]
+			try:
+				element = self.parseElement(page, name, args)
+			except (ValueError, IndexError):
+				# Unexpected arguments
+				element = None
+			if element is None:
+				element = Element(page, name, tuple(args))
+			elif isinstance(element, Page):
+				page = element.page
+			elements.append(element)
+		return elements
+
+	def parseElement(self, page, name, args):
+		'''! Builds a typed element from a layout command, internal usage
+		@return The element, None if it has no specific class
+		@throws ValueError, IndexError on unexpected arguments
+		'''
+		if name == 'page':
+			return Page(int(args[0]))
+
+		if name in ('button', 'buttontileart'):
+			x, y, released, pressed, type, param, id = map(int, args[:7])
+			return Button(page, x, y, released, pressed, type, param, id)
+
+		if name in ('checkbox', 'radio'):
+			x, y, released, pressed, checked, id = map(int, args[:6])
+			return Switch(page, x, y, released, pressed, bool(checked), id, name == 'radio')
+
+		if name in ('textentry', 'textentrylimited'):
+			x, y, width, height, hue, id, textid = map(int, args[:7])
+			limit = int(args[7]) if name == 'textentrylimited' else None
+			return TextEntry(page, x, y, width, height, hue, id, self.texts[textid], limit)
+
+		if name == 'text':
+			x, y, hue, textid = map(int, args[:4])
+			return Label(page, x, y, hue, self.texts[textid])
+
+		if name == 'croppedtext':
+			x, y, width, height, hue, textid = map(int, args[:6])
+			return Label(page, x, y, hue, self.texts[textid])
+
+		if name == 'htmlgump':
+			x, y, width, height, textid, background, scrollbar = map(int, args[:7])
+			return Html(page, x, y, width, height, self.texts[textid], None,
+					bool(background), bool(scrollbar))
+
+		if name in ('xmfhtmlgump', 'xmfhtmlgumpcolor'):
+			x, y, width, height, cliloc, background, scrollbar = map(int, args[:7])
+			return Html(page, x, y, width, height, None, cliloc, bool(background), bool(scrollbar))
+
+		return None
+
+	@staticmethod
+	def inflate(data, length):
+		'''! Inflates a zlib compressed block, internal usage
+		@param data bytes: The compressed data
+		@param length int: The expected inflated length
+		@return bytes
+		'''
+		if not data:
+			return b''
+		inflated = zlib.decompress(data)
+		if len(inflated) != length:
+			raise RuntimeError('Inflated {} bytes, expected {}'.format(len(inflated), length))
+		return inflated
+
+	def __repr__(self):
+		return 'Gump 0x{:X} serial 0x{:X} at {},{}'.format(self.gumpid, self.serial, self.x, self.y)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in server for Python Ultima Online text client
+Copyright (C) 2015-2016 Gabriele Tozzi
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+'''
+
+import socket
+import struct
+import threading
+import logging
+
+from . import net
+from . import packets
+
+
+class LoopbackServer(threading.Thread):
+	''' A minimal in-process server, useful for testing and benchmarking the client
+	without a real shard
+
+	Speaks the login server handshake (0x80, 0xA8, 0xA0, 0x8C) and the game
+	server one (0x91, 0xB9, 0xA9, 0x5D) on the same local port, then puts the
+	player in the world. After that, everything passed to send() is streamed
+	to the client compressed, while data sent by the client is collected.
+	'''
+
+	## Key sent with the 0x8C packet
+	KEY = 0x12345678
+	## Player's serial
+	SERIAL = 0x00000001
+	## Player's graphic
+	GRAPHIC = 0x0190
+	## Player's initial position (x, y, z, facing)
+	POSITION = (1000, 1000, 0, 0)
+
+	def __init__(self, user='test', pwd='test', chars=('Tester', )):
+		'''! Binds the listening socket, call start() to begin serving
+		@param user string: The accepted username
+		@param pwd string: The accepted password
+		@param chars tuple: Character names
+		'''
+		super().__init__()
+		self.daemon = True
+		## Logger, for internal usage
+		self.log = logging.getLogger('loopback')
+		## The accepted username
+		self.user = user
+		## The accepted password
+		self.pwd = pwd
+		## Character names
+		self.chars = chars
+
+		## Listening socket, for internal usage
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(2)
+		## Address to connect to
+		self.host, self.port = self.sock.getsockname()
+
+		## Game connection, set once the client logged in
+		self.game = None
+		## Set when the player has been put in the world
+		self.ready = threading.Event()
+		## Name of the character selected by client
+		self.charName = None
+		## Raw data received from the client after character selection
+		self.received = bytearray()
+		## Lock for received data
+		self.receivedLock = threading.Lock()
+
+	def run(self):
+		''' Called by threading '''
+		try:
+			self.login()
+			self.play()
+		except (OSError, EOFError) as e:
+			self.log.info('Connection closed: %s', e)
+		finally:
+			self.close()
+
+	def close(self):
+		''' Closes all the sockets, makes this object unusable '''
+		self.sock.close()
+		if self.game is not None:
+			self.game.close()
+
+	def send(self, *raws):
+		'''! Compresses and sends the given packets to the game client, in a single write
+		Waits for the player to be in the world
+		@param raws bytes: Uncompressed packets
+		'''
+		self.ready.wait()
+		self.write(raws)
+
+	def write(self, raws):
+		''' Compresses and sends the given packets on the game connection, internal usage '''
+		self.game.sendall(b''.join([net.Compressor.compress(raw) for raw in raws]))
+
+	def login(self):
+		''' Serves the login and game server handshakes, internal usage '''
+		# Login server
+		conn, addr = self.sock.accept()
+		with conn:
+			self.recvExactly(conn, 4) # Seed
+			pkt = self.recvExactly(conn, packets.LoginRequestPacket.length)
+			if not self.checkCredentials(pkt[1:31], pkt[31:61]):
+				conn.sendall(self.packet(packets.LoginDeniedPacket.cmd, 'B', 0x00))
+				raise EOFError('Login denied')
+			conn.sendall(self.packet(packets.ServerListPacket.cmd, 'BHH32sBB4s',
+					0x5d, 1, 0, b'pyuo loopback', 0, 0, bytes(reversed(socket.inet_aton(self.host))),
+					variable=True))
+			self.recvExactly(conn, 3) # 0xA0 server select
+			conn.sendall(self.packet(packets.ConnectToGameServerPacket.cmd, '4sHI',
+					socket.inet_aton(self.host), self.port, self.KEY))
+
+		# Game server
+		self.game, addr = self.sock.accept()
+		key = struct.unpack('>I', self.recvExactly(self.game, 4))[0]
+		if key != self.KEY:
+			raise EOFError('Invalid key {:08X}'.format(key))
+		pkt = self.recvExactly(self.game, packets.GameServerLoginPacket.length)
+		if not self.checkCredentials(pkt[5:35], pkt[35:65]):
+			raise EOFError('Login denied')
+		chars = b''.join([struct.pack('>30s30s', c.encode('ascii'), b'') for c in self.chars])
+		self.write((
+			self.packet(packets.EnableFeaturesPacket.cmd, 'H', 0x8003),
+			self.packet(packets.CharactersPacket.cmd, 'B{}sBI'.format(len(chars)),
+					len(self.chars), chars, 0, 0, variable=True),
+		))
+		pkt = self.recvExactly(self.game, packets.LoginCharacterPacket.length)
+		self.charName = packets.Packet.varStr(pkt[5:35])
+
+		# Put the player in the world
+		x, y, z, facing = self.POSITION
+		self.write((
+			self.packet(packets.CharLocaleBodyPacket.cmd, 'IIHHHBbbIIbHHHI',
+					self.SERIAL, 0, self.GRAPHIC, x, y, 0, z, facing, 0, 0, 0, 6136, 4096, 0, 0),
+			self.packet(packets.DrawGamePlayerPacket.cmd, 'IHBHBHHHbb',
+					self.SERIAL, self.GRAPHIC, 0, 0, 0, x, y, 0, facing, z),
+			self.packet(packets.LoginCompletePacket.cmd, ''),
+		))
+		self.ready.set()
+
+	def play(self):
+		''' Collects everything sent by the game client until disconnection, internal usage '''
+		while True:
+			data = self.game.recv(65536)
+			if not data:
+				break
+			with self.receivedLock:
+				self.received.extend(data)
+
+	def checkCredentials(self, user, pwd):
+		''' Checks the given raw username and password, internal usage '''
+		return packets.Packet.varStr(user) == self.user and packets.Packet.varStr(pwd) == self.pwd
+
+	@staticmethod
+	def recvExactly(sock, size):
+		''' Reads exactly size bytes from sock, internal usage '''
+		buf = bytearray()
+		while len(buf) < size:
+			data = sock.recv(size - len(buf))
+			if not data:
+				raise EOFError('Disconnected')
+			buf.extend(data)
+		return bytes(buf)
+
+	@staticmethod
+	def packet(cmd, fmt, *values, variable=False):
+		'''! Builds a raw uncompressed packet
+		@param cmd int: The packet ID
+		@param fmt string: struct format of the packet body, big endian is implied
+		@param values: The values to pack
+		@param variable bool: Whether the packet has a variable length, includes the length field
+		@return bytes
+		'''
+		body = struct.pack('>' + fmt, *values)
+		if variable:
+			return struct.pack('>BH', cmd, len(body) + 3) + body
+		return struct.pack('>B', cmd) + body
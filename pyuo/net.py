@@ -21,6 +21,8 @@ Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
 import time
 import socket
+import select
+import collections
 import struct
 import ipaddress
 import logging
@@ -28,9 +30,139 @@ import logging
 from . import packets
 
 
-class Network:
+class PacketReader:
+	''' Splits and decodes the data received from the server into packets
+
+	Does no I/O by itself: the caller writes incoming data into the buffer
+	returned by getBuffer(), then calls bufferUpdated()
+	'''
+
+	## Initial size of the receive buffer, grows when needed
+	BUFSIZE = 65536
+
+	def __init__(self):
+		## Logger, for internal usage
+		self.log = logging.getLogger('net')
+		## Receive buffer, for internal usage. Valid data is in [bufStart:bufEnd]
+		self.buf = bytearray(self.BUFSIZE)
+		## Offset of the first unread byte in the receive buffer, for internal usage
+		self.bufStart = 0
+		## Offset of the end of valid data in the receive buffer, for internal usage
+		self.bufEnd = 0
+		## Wether to use compression or not
+		self.compress = False
+		## Wether to defer the decoding of packets to the first access to their fields
+		self.lazy = False
+		## IDs of the packets that are framed but never decoded, returned as empty instances
+		self.skip = frozenset()
+		## Streaming decompressor, for internal usage
+		self.decompressor = Decompressor()
+		## Decompressed packets not yet returned, as (raw, compressed size), for internal usage
+		self.inqueue = collections.deque()
+
+	def getBuffer(self):
+		'''! Returns the free part of the receive buffer, where new data must be written
+		The buffer is compacted, or grown when full, so data is never copied on every read
+		@return memoryview
+		'''
+		if self.bufStart == self.bufEnd:
+			self.bufStart = self.bufEnd = 0
+		elif self.bufEnd == len(self.buf):
+			pending = self.bufEnd - self.bufStart
+			if self.bufStart:
+				# Move pending data to the start of the buffer
+				self.buf[:pending] = self.buf[self.bufStart:self.bufEnd]
+			else:
+				self.buf.extend(bytes(len(self.buf)))
+			self.bufStart = 0
+			self.bufEnd = pending
+
+		return memoryview(self.buf)[self.bufEnd:]
+
+	def bufferUpdated(self, read):
+		'''! Tells that new data has been written in the buffer returned by getBuffer()
+		@param read int: Number of bytes written
+		'''
+		self.bufEnd += read
+
+		if self.compress:
+			# Only the newly arrived bytes are decompressed
+			self.inqueue.extend(self.decompressor.decompress(
+					memoryview(self.buf)[self.bufStart:self.bufEnd]))
+			self.bufStart = self.bufEnd
+
+	def available(self):
+		''' Tells whether a full packet is available in the buffers '''
+		if self.compress:
+			return len(self.inqueue) > 0
+		if self.bufEnd == self.bufStart:
+			return False
+		length = self.frameLength(memoryview(self.buf)[self.bufStart:self.bufEnd])
+		return length is not None and self.bufStart + length <= self.bufEnd
+
+	@staticmethod
+	def frameLength(buf):
+		'''! Tells the length of the uncompressed packet at the start of buf, internal usage
+		Uses the fixed length from the packets registry, or the length sent with variable size packets
+
+		@param buf bytes: The buffer, must not be empty
+		@return int: The length, None if buf is still too short to tell
+		@throws NotImplementedError
+		'''
+		length = packets.lengths[buf[0]]
+		if length is None:
+			raise NotImplementedError(
+					"Unknown packet 0x%0.2X, %d bytes\n%s" % (buf[0], len(buf), bytes(buf)))
+		if length == packets.VARIABLE:
+			if len(buf) < 3:
+				return None
+			length = buf[1] << 8 | buf[2]
+		return length
+
+	def decodeNext(self):
+		''' Decodes and returns next full packet from the buffers '''
+		if self.compress:
+			raw, size = self.inqueue.popleft()
+		else:
+			size = self.frameLength(memoryview(self.buf)[self.bufStart:self.bufEnd])
+			raw = memoryview(self.buf)[self.bufStart:self.bufStart+size]
+
+		if not raw:
+			raise NotImplementedError()
+
+		if self.log.isEnabledFor(logging.DEBUG):
+			cinfo = '{} compressed'.format(size) if self.compress else 'not compressed'
+			self.log.debug('<- 0x%0.2X, %d bytes, %s\n"%s"', raw[0], len(raw), cinfo, bytes(raw))
+
+		# Creates and instance of the packet from the buffer
+		cmd = raw[0]
+		pktClass = packets.registry[cmd]
+		if pktClass is None:
+			raise NotImplementedError(
+					"Unknown packet 0x%0.2X, %d bytes\n%s" % (cmd, len(raw), bytes(raw)))
+		pkt = pktClass()
+		if cmd in self.skip:
+			pass
+		elif self.lazy:
+			pkt.decodeLazy(raw)
+		else:
+			pkt.decode(raw)
+			assert pkt.validated
+			assert pkt.length == len(raw)
+
+		# Remove the processed packet from the buffer
+		if not self.compress:
+			self.bufStart += size
+
+		return pkt
+
+
+class Network(PacketReader):
 	''' Network handler '''
 
+	## Header of every read copied to record: compression flag, number of bytes
+	RECORD_HEADER = struct.Struct('>?I')
+
 	## Decompression Tree, internal usage. Thanks to UOXNA project
 	DECOMPRESSION_TREE = (
 		# leaf0, leaf1, #node
@@ -93,22 +225,28 @@ class Network:
 			@param ip IPv4Address: the IP object, from the ipaddress module
 			@param port int: the port
 		'''
-		## Logger, for internal usage
-		self.log = logging.getLogger('net')
+		super().__init__()
 		## Socket connection, for internal usage
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.sock.connect((str(ip), port))
-		## Buffer, for internal usage
-		self.buf = b''
-		## Wether to use compression or not
-		self.compress = False
+		## Binary file where received data is copied, used to record a traffic
+		## corpus for benchmark.py: every read is written after a RECORD_HEADER
+		self.record = None
 
 	def close(self):
 		''' Disconnects, makes this object unusable '''
 		self.sock.close()
 
-	def send(self, data):
-		''' Sends a packet or raw binary data '''
+	def fileno(self):
+		''' Returns the socket's file descriptor, allows waiting on this object with selectors '''
+		return self.sock.fileno()
+
+	@staticmethod
+	def encode(data):
+		'''! Encodes a packet for sending, internal usage
+		@param data Packet/bytes: The packet or raw binary data
+		@return bytes
+		'''
 		if isinstance(data, packets.Packet):
 			raw = data.encode()
 			assert data.validated
@@ -116,103 +254,279 @@ class Network:
 			raw = data
 		else:
 			raise ValueError('Expecting Packet or bytes')
+		return raw
 
-		self.log.debug('-> 0x%0.2X, %d bytes\n"%s"', raw[0], len(raw), raw)
-		self.sock.send(raw)
-
-	def recv(self, force=False, blocking=True):
-		'''! Reads next packet from the server
-		Always returns a full packet (waiting for full packet is always blocking)
+	def send(self, data):
+		''' Sends a packet or raw binary data '''
+		self.sendMany((data, ))
 
-		@param force bool: Force wait, used internally
+	def sendMany(self, datas):
+		'''! Sends many packets or raw binary data at once, using a single buffer
+		@param datas list: list of Packet or bytes
+		'''
+		raws = []
+		for data in datas:
+			raw = self.encode(data)
+			self.log.debug('-> 0x%0.2X, %d bytes\n"%s"', raw[0], len(raw), raw)
+			raws.append(raw)
+		self.write(b''.join(raws))
+
+	def write(self, raw):
+		'''! Writes all the given data to the socket, internal usage
+		Handles partial writes, also when the socket is not blocking
+		@param raw bytes: The data to be written
+		'''
+		view = memoryview(raw)
+		while view:
+			try:
+				sent = self.sock.send(view)
+			except BlockingIOError:
+				# Send buffer is full, wait for the socket to become writable
+				select.select((), (self.sock, ), ())
+				continue
+			view = view[sent:]
+
+	def read(self, blocking=True):
+		'''! Reads once from the socket into the buffers, internal usage
 		@param blocking bool: Set blocking mode
+		@return bool: False if not blocking and no data was available
 		'''
-
 		self.sock.setblocking(blocking)
 
-		# Wait for a full packet
-		if len(self.buf) < 1 or force:
-			try:
-				data = self.sock.recv(4096)
-			except socket.error:
-				if not blocking:
-					return None
-				else:
-					raise
+		buf = self.getBuffer()
+		try:
+			read = self.sock.recv_into(buf)
+		except socket.error:
+			if not blocking:
+				return False
+			else:
+				raise
 
-			if not len(data):
-				raise RuntimeError("Disconnected");
+		if not read:
+			raise DisconnectedError("Disconnected");
 
-			self.buf += data
+		if self.record is not None:
+			self.record.write(self.RECORD_HEADER.pack(self.compress, read))
+			self.record.write(buf[:read])
+		self.bufferUpdated(read)
+		return True
 
-		if self.compress:
-			try:
-				raw, size = self.decompress(self.buf)
-			except NoFullPacketError:
-				# Not enough data to make a full packet. Try again
-				self.log.debug("No full packet. Waiting... (%d bytes in buffer)", len(self.buf))
-				return self.recv(True)
-		else:
-			raw = self.buf
-			size = len(self.buf)
+	def recv(self, force=False, blocking=True):
+		'''! Reads next packet from the server
+		Always returns a full packet (waiting for full packet is always blocking)
 
-		if not raw:
-			raise NotImplementedError()
+		@param force bool: Force wait, used internally
+		@param blocking bool: Set blocking mode
+		'''
 
-		cinfo = '{} compressed'.format(size) if self.compress else 'not compressed'
-		self.log.debug('<- 0x%0.2X, %d bytes, %s\n"%s"', raw[0], len(raw), cinfo, raw)
+		# Wait for a full packet
+		if force or not self.available():
+			if not self.read(blocking):
+				return None
 
-		# Creates and instance of the packet from the buffer
-		cmd = raw[0]
-		if cmd not in packets.classes.keys():
-			raise NotImplementedError(
-					"Unknown packet 0x%0.2X, %d bytes\n%s" % (cmd, len(raw), raw))
-		pktClass = packets.classes[cmd]
-		pkt = pktClass()
-		pkt.decode(raw)
-		assert pkt.validated
-		assert pkt.length == len(raw)
+		if not self.available():
+			# Not enough data to make a full packet. Try again
+			self.log.debug("No full packet. Waiting... (%d bytes decompressed so far)",
+					len(self.decompressor.dest))
+			return self.recv(True)
 
-		# Remove the processed packet from the buffer the buffer
-		self.buf = self.buf[size:]
+		return self.decodeNext()
 
-		return pkt
+	def recvMany(self, blocking=True):
+		'''! Reads from the server, returns all the full packets available at once
+		A single read is done when not blocking, when blocking waits for at least a full packet
 
-	def decompress(self, buf):
-		'''! Internal usage, decompress a packet (thanks to UltimaXNA project
+		@param blocking bool: Set blocking mode
+		@return list of Packet, empty if not blocking and no full packet available
+		'''
+		while not self.available():
+			if not self.read(blocking):
+				return []
+			if not blocking:
+				break
+
+		pkts = []
+		while self.available():
+			pkts.append(self.decodeNext())
+		return pkts
+
+	@staticmethod
+	def decompress(buf):
+		'''! Internal usage, decompress a single packet from the start of buf
 		@return tuple (decompressed, compressed_size)
+		@throws NoFullPacketError
+		'''
+		decompressor = Decompressor()
+		done = decompressor.decompress(buf, 1)
+		if not done:
+			raise NoFullPacketError("No full packet could be read")
+		return done[0]
+
+
+class Decompressor:
+	''' Stateful, table driven Huffman decompressor (thanks to UltimaXNA project)
+
+	Keeps the current tree node and the partial output between calls, so a
+	packet split across many reads is decoded only once, as its bytes arrive.
+	A whole input byte is decoded at every step, looking up the precomputed
+	(node, byte) transition in TABLE.
+	'''
+
+	## Decompression Tree, see Network.DECOMPRESSION_TREE
+	TREE = Network.DECOMPRESSION_TREE
+	## Special codeword marking the end of a packet
+	HALT = -256
+	## Transitions table, (node << 8 | byte) -> (next node, decoded bytes, halt), built on first use
+	TABLE = None
+	## Maximum number of bytes decoded from a single input byte
+	MAX_OUT = None
+
+	@classmethod
+	def buildTable(cls):
+		''' Precomputes the transitions table, internal usage '''
+		table = []
+		for start in range(len(cls.TREE)):
+			for byte in range(256):
+				node = start
+				out = bytearray()
+				halt = False
+				for bitNum in range(7, -1, -1):
+					leafVal = cls.TREE[node][( byte >> bitNum ) & 1]
+					if leafVal == cls.HALT:
+						# The remaining bits of this byte are padding
+						halt = True
+						node = 0
+						break
+					elif leafVal < 1:
+						out.append(0 - leafVal)
+						leafVal = 0
+					node = leafVal
+				table.append(( node, bytes(out), halt ))
+		cls.TABLE = tuple(table)
+		cls.MAX_OUT = max([len(t[1]) for t in table])
+
+	def __init__(self):
+		if self.TABLE is None:
+			self.buildTable()
+		## Current node in the decompression tree
+		self.node = 0
+		## Decompressed data of the packet being read
+		self.dest = bytearray()
+		## Compressed bytes consumed by the packet being read
+		self.size = 0
+		## Output buffer, reused and grown as needed, internal usage
+		self.out = bytearray()
+
+	def decompress(self, buf, limit=None):
+		'''! Decompresses newly arrived data, remembering incomplete packets
+		@param buf bytes: The compressed data, following the previous call's one
+		@param limit int: Stop after this many packets, leaving the rest of buf unread
+		@return list of tuples (decompressed, compressed_size) of completed packets
+		'''
+		table = self.TABLE
+		node = self.node
+		size = self.size
+		done = []
+
+		# Output is written in place into a buffer large enough for the worst case
+		if len(self.out) < len(buf) * self.MAX_OUT:
+			self.out = bytearray(len(buf) * self.MAX_OUT)
+		out = self.out
+		pos = 0
+		start = 0
+
+		for byte in buf:
+			size += 1
+			node, dec, halt = table[node << 8 | byte]
+			if dec:
+				end = pos + len(dec)
+				out[pos:end] = dec
+				pos = end
+			if halt:
+				if self.dest:
+					self.dest += out[start:pos]
+					done.append(( bytes(self.dest), size ))
+					self.dest = bytearray()
+				else:
+					done.append(( bytes(out[start:pos]), size ))
+				start = pos
+				size = 0
+				if limit is not None and len(done) >= limit:
+					break
+
+		self.dest += out[start:pos]
+		self.node = node
+		self.size = size
+		return done
+
+
+class Compressor:
+	''' Huffman compressor, the counterpart of Decompressor, as used by the server
+
+	Every packet is compressed on its own, terminated by the halt codeword
+	and padded to a byte boundary.
+	'''
+
+	## Decompression Tree, see Network.DECOMPRESSION_TREE
+	TREE = Network.DECOMPRESSION_TREE
+	## Codes table, symbol -> (code, number of bits), the halt codeword is symbol 256, built at import
+	CODES = None
+
+	@classmethod
+	def buildTable(cls):
+		''' Precomputes the codes table by walking the tree, internal usage '''
+		codes = [None] * 257
+		nodes = [(0, 0, 0)]
+		while nodes:
+			node, code, bits = nodes.pop()
+			for leaf in (0, 1):
+				leafVal = cls.TREE[node][leaf]
+				if leafVal < 1:
+					codes[0 - leafVal] = (code << 1 | leaf, bits + 1)
+				else:
+					nodes.append((leafVal, code << 1 | leaf, bits + 1))
+		assert None not in codes
+		cls.CODES = tuple(codes)
+
+	@classmethod
+	def compress(cls, data):
+		'''! Compresses a single packet
+		@param data bytes: The uncompressed packet
+		@return bytes: The compressed packet, including the halt codeword
 		'''
-		node = 0
-		leaf = 0
-		leafVal = 0
-		bitNum = 8
-		srcPos = 0
-		dest = b''
-
-		while srcPos < len(buf):
-			# Gets next bit
-			leaf = ( buf[srcPos] >> ( bitNum - 1 ) ) & 1
-			# Look into decompression table
-			leafVal = self.DECOMPRESSION_TREE[node][leaf]
-
-			# all numbers below 1 (0..-256) are codewords
-			# if the halt codeword has been found, skip this byte
-			if leafVal == -256:
-				return ( dest, srcPos + 1)
-			elif leafVal < 1:
-				dest += bytes([0 - leafVal])
-				leafVal = 0
-
-			# Go for next bit, if its the end of the byte, go to the next byte
-			bitNum -= 1
-			node = leafVal
-			if bitNum < 1:
-				bitNum = 8;
-				srcPos += 1
-
-		raise NoFullPacketError("No full packet could be read")
+		codes = cls.CODES
+		out = bytearray()
+		acc = 0
+		accBits = 0
+		for byte in data:
+			code, bits = codes[byte]
+			acc = acc << bits | code
+			accBits += bits
+			while accBits >= 8:
+				accBits -= 8
+				out.append(acc >> accBits & 0xff)
+			acc &= ( 1 << accBits ) - 1
+
+		# Append halt codeword and pad to next byte
+		code, bits = codes[256]
+		acc = acc << bits | code
+		accBits += bits
+		while accBits >= 8:
+			accBits -= 8
+			out.append(acc >> accBits & 0xff)
+		if accBits:
+			out.append(acc << ( 8 - accBits ) & 0xff)
+		return bytes(out)
+
+
+Compressor.buildTable()
 
 
 class NoFullPacketError(Exception):
 	''' Exception thrown when no full packet is available '''
 	pass
+
+
+class DisconnectedError(RuntimeError):
+	''' Exception thrown when the server closed the connection '''
+	pass
@@ -21,10 +21,9 @@ Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
 import struct
 import logging
+import threading
 import ipaddress
-import zlib
-import sys
-import inspect
+import collections
 
 
 ################################################################################
@@ -32,13 +31,74 @@ import inspect
 ################################################################################
 
 
-class Packet():
-	''' Base class for packets '''
+class PacketMeta(type):
+	''' Metaclass for packets: makes every packet class slotted, so instances
+	have no __dict__
+
+	The slots of a class are the names in its fields plus the ones listed in
+	its __slots__, except the ones already slotted by a base class.
+	Also compiles the fields and collects the packet classes, so the module
+	needs no scan at import
+	'''
+
+	## Classes declaring their own cmd, in definition order, internal usage
+	defined = []
+
+	def __new__(mcs, name, bases, namespace):
+		inherited = []
+		for base in bases:
+			inherited.extend(getattr(base, 'slotNames', ()))
+		slots = list(namespace.get('__slots__', ()))
+		for field, fmt in namespace.get('fields') or ():
+			if field is not None:
+				slots.append(field)
+		slots = tuple(s for s in dict.fromkeys(slots) if s not in inherited)
+		namespace['__slots__'] = slots
+		cls = super().__new__(mcs, name, bases, namespace)
+		## Names of all the instance attributes, internal usage
+		cls.slotNames = tuple(inherited) + slots
+
+		if namespace.get('fields') is not None:
+			cls.compileFields()
+		if 'cmd' in namespace:
+			mcs.defined.append(cls)
+		return cls
+
+
+class Packet(metaclass=PacketMeta):
+	''' Base class for packets
+
+	Packets are slotted: derived classes must list in __slots__ all the
+	attributes they set, except the ones declared in fields
+	'''
+
+	__slots__ = ('validated', 'buf', 'readCount', 'writeCount', 'lenIdx', 'lazyBuf')
+
+	## Logger, for internal usage
+	log = logging.getLogger('packet')
+	## Serializes the deferred decoding of lazy packets, internal usage
+	lazyLock = threading.RLock()
+
+	## Declarative layout of packets with fixed layout, used by the default decodeChild():
+	## tuple of (name, format) pairs following the cmd byte, where format is a struct
+	## format (big endian implied) and name is None for unused bytes
+	fields = None
+	## struct.Struct precompiled from fields at import, internal usage
+	fieldsStruct = None
+	## Names of the values unpacked by fieldsStruct, internal usage
+	fieldsNames = None
+
+	## Precompiled structs used by decode and encode methods, internal usage
+	UCHAR = struct.Struct('B')
+	SCHAR = struct.Struct('b')
+	USHORT = struct.Struct('>H')
+	UINT = struct.Struct('>I')
+	IP = struct.Struct('BBBB')
 
 	def __init__(self):
 		assert self.cmd
-		self.log = logging.getLogger('packet')
 		self.validated = False
+		self.lazyBuf = None
 
 	def fill(self):
 		''' Fills the packet with the given data, sort of delayed constructor '''
@@ -47,33 +107,103 @@ class Packet():
 	def decode(self, buf):
 		'''! Parses the data from the given buffer into this packet instance
 		@see decodeChild
-		@param buf binary: The binary buffer, as received from server
+		@param buf binary: The binary buffer, as received from server (bytes or memoryview)
 		'''
-		self.buf = buf
+		# Data is read in place, readCount is the offset of the next byte to read
+		self.buf = memoryview(buf)
 		self.readCount = 0
-		cmd = self.duchar()
-		if cmd != self.cmd:
-			raise RuntimeError("Invalid data for this packet {} <> {}".format(cmd, self.cmd))
-
-		self.decodeChild()
-
-		# Validate the process
-		if self.length != self.readCount:
-			self.log.debug(self.__dict__)
-			raise RuntimeError("Len mismatch on incomingpacket 0x{:02x} ({} <> {})".format(
-					self.cmd, self.length, self.readCount))
-		self.validated = True
+		try:
+			cmd = self.duchar()
+			if cmd != self.cmd:
+				raise RuntimeError("Invalid data for this packet {} <> {}".format(cmd, self.cmd))
+
+			self.decodeChild()
+
+			# Validate the process
+			if self.length != self.readCount:
+				self.log.debug(repr(self))
+				raise RuntimeError("Len mismatch on incomingpacket 0x{:02x} ({} <> {})".format(
+						self.cmd, self.length, self.readCount))
+			self.validated = True
+		finally:
+			# Do not keep a reference to the receive buffer
+			self.buf = None
+
+	def decodeLazy(self, buf):
+		'''! Keeps a copy of the given buffer, decode() is deferred to the first
+		access to an attribute that is not set yet
+		@param buf binary: The binary buffer, as received from server (bytes or memoryview)
+		'''
+		self.lazyBuf = bytes(buf)
+
+	def __getattr__(self, name):
+		# Only called for missing attributes: decodes lazy packets on first access
+		if name == 'lazyBuf':
+			raise AttributeError(name)
+		with self.lazyLock:
+			buf = self.lazyBuf
+			if buf is not None:
+				# Cleared while decoding, so reads from decode() itself don't recurse;
+				# restored on failure, so every access raises the decode error
+				self.lazyBuf = None
+				try:
+					self.decode(buf)
+				except:
+					self.lazyBuf = buf
+					raise
+		# Not lazy, or decoded here or meanwhile by another thread
+		return object.__getattribute__(self, name)
+
+	def __repr__(self):
+		values = ['{}={!r}'.format(name, getattr(self, name)) for name in self.slotNames
+				if name not in ('buf', 'lazyBuf') and hasattr(self, name)]
+		return '<{} {}>'.format(self.__class__.__name__, ' '.join(values))
 
 	def decodeChild(self):
-		''' Derived classes must ovveride this method to do the decoding '''
-		raise NotImplementedError('this method must be overridden')
+		''' Derived classes must ovveride this method to do the decoding, unless
+		they declare fields: then all fields are unpacked with a single call '''
+		if self.fieldsStruct is None:
+			raise NotImplementedError('this method must be overridden')
+		for name, value in zip(self.fieldsNames, self.dunpack(self.fieldsStruct)):
+			setattr(self, name, value)
+
+	@classmethod
+	def compileFields(cls):
+		''' Builds fieldsStruct and fieldsNames from fields, called when the class is created '''
+		fmt = '>'
+		names = []
+		for name, field in cls.fields:
+			if name is None:
+				fmt += '{}x'.format(struct.calcsize('>' + field))
+			else:
+				fmt += field
+				names.append(name)
+		cls.fieldsStruct = struct.Struct(fmt)
+		cls.fieldsNames = tuple(names)
+
+		length = cls.fixedLength()
+		if length is not None and length != cls.fieldsStruct.size + 1:
+			raise RuntimeError("Fields of {} take {} bytes, length is {}".format(
+					cls.__name__, cls.fieldsStruct.size + 1, length))
+
+	@classmethod
+	def fixedLength(cls):
+		'''! Tells the length of the packets of this class
+		@return int: The length, None for variable length packets
+		'''
+		# Variable length packets have a slot for it, not an int
+		length = getattr(cls, 'length', None)
+		return length if isinstance(length, int) else None
 
 	def encode(self):
 		'''! Encodes the data into a buffer and returns it
 		@see encodeChild
 		@return binary: The binary buffer, ready to be sent to server
 		'''
-		self.buf = b''
+		# Data is written in place, in a buffer preallocated to the expected length;
+		# writeCount is the offset of the next byte to write
+		self.buf = bytearray(getattr(self, 'length', 0))
+		self.writeCount = 0
 		self.euchar(self.cmd)
 
 		# Used by self.eulen()
@@ -83,15 +213,16 @@ class Packet():
 
 		# Replace length if needed
 		if self.lenIdx is not None:
-			self.buf = self.buf[:self.lenIdx] + struct.pack('>H', len(self.buf)) + self.buf[self.lenIdx+2:]
+			self.USHORT.pack_into(self.buf, self.lenIdx, self.writeCount)
 		del self.lenIdx
 
 		# Validate the process
-		if self.length != len(self.buf):
+		if self.length != self.writeCount or len(self.buf) != self.writeCount:
 			raise RuntimeError("Len mismatch on outgoing packet 0x{:02x} ({} <> {})".format(
-					self.cmd, self.length, len(self.buf)))
+					self.cmd, self.length, self.writeCount))
 		self.validated = True
 
+		self.buf = bytes(self.buf)
 		return self.buf
 
 	def encodeChild(self):
@@ -100,30 +231,44 @@ class Packet():
 
 	# Decode methods -----------------------------------------------------------
 
+	def remaining(self):
+		''' Returns the number of bytes left to be read in the receive buffer '''
+		return len(self.buf) - self.readCount
+
 	def rpb(self, num):
-		''' Returns the given number of characters from the receive buffer '''
-		if num > len(self.buf):
-			raise EOFError("Trying to read {} bytes, but only {} left in buffer".format(num, len(self.buf)))
-		self.readCount += num
-		ret = self.buf[:num]
-		self.buf = self.buf[num:]
-		return ret
+		''' Returns the given number of characters from the receive buffer, as a memoryview '''
+		start = self.readCount
+		if num > len(self.buf) - start:
+			raise EOFError("Trying to read {} bytes, but only {} left in buffer".format(num, len(self.buf) - start))
+		self.readCount = start + num
+		return self.buf[start:self.readCount]
+
+	def dunpack(self, st):
+		'''! Unpacks next values from the receive buffer, in place
+		@param st struct.Struct: The struct describing the values
+		@return tuple
+		'''
+		start = self.readCount
+		if st.size > len(self.buf) - start:
+			raise EOFError("Trying to read {} bytes, but only {} left in buffer".format(st.size, len(self.buf) - start))
+		self.readCount = start + st.size
+		return st.unpack_from(self.buf, start)
 
 	def duchar(self):
 		''' Returns next unsngned byte from the receive buffer '''
-		return struct.unpack('B', self.rpb(1))[0]
+		return self.dunpack(self.UCHAR)[0]
 
 	def dschar(self):
 		''' Returns next signed byte from the receive buffer '''
-		return struct.unpack('b', self.rpb(1))[0]
+		return self.dunpack(self.SCHAR)[0]
 
 	def dushort(self):
 		''' Returns next unsigned short from the receive buffer '''
-		return struct.unpack('>H', self.rpb(2))[0]
+		return self.dunpack(self.USHORT)[0]
 
 	def duint(self):
 		''' Returns next unsigned int from the receive buffer '''
-		return struct.unpack('>I', self.rpb(4))[0]
+		return self.dunpack(self.UINT)[0]
 
 	def dstring(self, length):
 		''' Returns next string of the given length from the receive buffer '''
@@ -137,13 +282,30 @@ class Packet():
 
 	def dip(self):
 		''' Returns next string ip address from the receive buffer '''
-		return struct.unpack('BBBB', self.rpb(4))
+		return self.dunpack(self.IP)
 
 	# Encode methods -----------------------------------------------------------
 
+	def epack(self, st, *values):
+		'''! Packs the given values at the end of the send buffer, in place
+		@param st struct.Struct: The struct describing the values
+		'''
+		start = self.writeCount
+		self.writeCount = start + st.size
+		if self.writeCount > len(self.buf):
+			# Longer than expected, length mismatch will be detected later
+			self.buf.extend(bytes(self.writeCount - len(self.buf)))
+		st.pack_into(self.buf, start, *values)
+
+	def ewrite(self, data):
+		''' Writes the given raw bytes at the end of the send buffer, in place '''
+		start = self.writeCount
+		self.writeCount = start + len(data)
+		self.buf[start:self.writeCount] = data
+
 	def eulen(self):
 		''' Special value: will place there an ushort containing packet length '''
-		self.lenIdx = len(self.buf)
+		self.lenIdx = self.writeCount
 		self.eushort(0)
 
 	def euchar(self, val):
@@ -152,7 +314,7 @@ class Packet():
 			raise TypeError("Expected int, got {}".format(type(val)))
 		if val < 0 or val > 255:
 			raise ValueError("Byte {} out of range".format(val))
-		self.buf += struct.pack('B', val)
+		self.epack(self.UCHAR, val)
 
 	def eschar(self, val):
 		''' Add a signed char (byte) to the packet '''
@@ -160,7 +322,7 @@ class Packet():
 			raise TypeError("Expected int, got {}".format(type(val)))
 		if val < 0 or val > 255:
 			raise ValueError("Byte {} out of range".format(val))
-		self.buf += struct.pack('b', val)
+		self.epack(self.SCHAR, val)
 
 	def eushort(self, val):
 		''' Adds an unsigned short to the packet '''
@@ -168,7 +330,7 @@ class Packet():
 			raise TypeError("Expected int, got {}".format(type(val)))
 		if val < 0 or val > 0xffff:
 			raise ValueError("UShort {} out of range".format(val))
-		self.buf += struct.pack('>H', val)
+		self.epack(self.USHORT, val)
 
 	def euint(self, val):
 		''' Adds and unsigned int to the packet '''
@@ -176,7 +338,7 @@ class Packet():
 			raise TypeError("Expected int, got {}".format(type(val)))
 		if val < 0 or val > 0xffffffff:
 			raise ValueError("UInt {} out of range".format(val))
-		self.buf += struct.pack('>I', val)
+		self.epack(self.UINT, val)
 
 	def estring(self, val, length, unicode=False):
 		''' Adds a string to the packet '''
@@ -184,13 +346,13 @@ class Packet():
 			raise TypeError("Expected str, got {}".format(type(val)))
 		if len(val) > length:
 			raise ValueError('String "{}" too long'.format(val))
-		self.buf += self.fixStr(val, length, unicode)
+		self.ewrite(self.fixStr(val, length, unicode))
 
 	def eip(self, val):
 		''' Adds an ip to the packet '''
 		if not isinstance(val, str):
 			raise TypeError("Expected str, got {}".format(type(val)))
-		self.buf += ipaddress.ip_address(val).packed
+		self.ewrite(ipaddress.ip_address(val).packed)
 
 	# Utility methods ----------------------------------------------------------
 
@@ -198,30 +360,25 @@ class Packet():
 	def fixStr(string, length, unicode=False):
 		''' Convert a str to fixed length, return bytes '''
 		##TODO: Better handling on unicode
-		enc = string.encode('ascii')
-		ret = b''
-		for i in range(0,length):
-			if unicode:
-				ret += b'\x00'
-			try:
-				ret += bytes([enc[i]])
-			except IndexError:
-				ret += b'\x00'
-		return ret
+		enc = string[:length].encode('ascii')
+		if unicode:
+			# ASCII chars only, so every char takes exactly two bytes
+			return enc.decode('ascii').encode('utf_16_be').ljust(length * 2, b'\x00')
+		return enc.ljust(length, b'\x00')
 
 	@staticmethod
 	def varStr(byt):
 		''' Convert bytes into a variable-length string '''
 		try:
-			dec = byt.decode('utf8')
+			dec = str(byt, 'utf8')
 		except UnicodeDecodeError:
-			dec = byt.decode('iso8859-15')
+			dec = str(byt, 'iso8859-15')
 		return Packet.nullTrunc(dec)
 
 	@staticmethod
 	def varUStr(byt):
 		''' Convert unicode bytes into a variable-length string '''
-		dec = byt.decode('utf_16_be')
+		dec = str(byt, 'utf_16_be')
 		return Packet.nullTrunc(dec)
 
 	@staticmethod
@@ -243,10 +400,11 @@ class UpdateVitalPacket(Packet):
 
 	length = 9
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.max = self.dushort()
-		self.cur = self.dushort()
+	fields = (
+		('serial', 'I'),
+		('max', 'H'),
+		('cur', 'H'),
+	)
 
 
 class SerialOnlyPacket(Packet):
@@ -254,6 +412,10 @@ class SerialOnlyPacket(Packet):
 
 	length = 5
 
+	fields = (
+		('serial', 'I'),
+	)
+
 	def fill(self, serial):
 		'''!
 		@param serial int: The object serial
@@ -263,8 +425,18 @@ class SerialOnlyPacket(Packet):
 	def encodeChild(self):
 		self.euint(self.serial)
 
-	def decodeChild(self):
-		self.serial = self.duint()
+
+class ContainerItem(collections.namedtuple('ContainerItem',
+		('serial', 'graphic', 'unknown', 'amount', 'x', 'y', 'container', 'color'))):
+	''' An item record in AddItemsToContainerPacket, a compact tuple with named fields '''
+
+	__slots__ = ()
+
+
+class EquipItem(collections.namedtuple('EquipItem', ('serial', 'graphic', 'layer', 'color'))):
+	''' An equipped item record in DrawObjectPacket, a compact tuple with named fields '''
+
+	__slots__ = ()
 
 
 ################################################################################
@@ -278,6 +450,8 @@ class MoveRequestPacket(Packet):
 	cmd = 0x02
 	length = 7
 
+	__slots__ = ('direction', 'sequence')
+
 	def fill(self, direction, sequence):
 		'''!
 		@param direction int: The direction code (0-7)
@@ -309,6 +483,16 @@ class StatusBarInfoPacket(Packet):
 
 	cmd = 0x11
 
+	__slots__ = (
+		'length', 'serial', 'name', 'hp', 'maxhp', 'canrename', 'gener', 'str', 'dex', 'int',
+		'stam', 'maxstam', 'mana', 'maxmana', 'gold', 'ar', 'weight', 'maxweight', 'race',
+		'statcap', 'followers', 'maxfollowers', 'rfire', 'rcold', 'rpoison', 'renergy', 'luck',
+		'mindmg', 'maxdmg', 'tithing', 'hitinc', 'swinginc', 'dmginc', 'lrc', 'hpregen',
+		'stamregen', 'manaregen', 'reflectphysical', 'enhancepot', 'definc', 'spellinc', 'fcr',
+		'fc', 'lmc', 'strinc', 'dexinc', 'intinc', 'hpinc', 'staminc', 'manainc', 'maxhpinc',
+		'maxstaminc', 'maxmanainc',
+	)
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -379,6 +563,8 @@ class ObjectInfoPacket(Packet):
 
 	cmd = 0x1a
 
+	__slots__ = ('length', 'serial', 'graphic', 'z', 'x', 'y', 'count', 'facing', 'color', 'flag')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -414,22 +600,23 @@ class CharLocaleBodyPacket(Packet):
 	cmd = 0x1b
 	length = 37
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		unk = self.duint() # Uknown
-		self.bodyType = self.dushort()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		unk = self.duchar() # Unknown
-		self.z = self.dschar()
-		self.facing = self.dschar()
-		unk = self.duint() # Unknown
-		unk = self.duint() # Unknown
-		unk = self.dschar() # Unknown
-		self.widthM8 = self.dushort()
-		self.height = self.dushort()
-		unk = self.dushort() # Unknown
-		unk = self.duint() # Unknown
+	fields = (
+		('serial', 'I'),
+		(None, 'I'), # Unknown
+		('bodyType', 'H'),
+		('x', 'H'),
+		('y', 'H'),
+		(None, 'B'), # Unknown
+		('z', 'b'),
+		('facing', 'b'),
+		(None, 'I'), # Unknown
+		(None, 'I'), # Unknown
+		(None, 'b'), # Unknown
+		('widthM8', 'H'),
+		('height', 'H'),
+		(None, 'H'), # Unknown
+		(None, 'I'), # Unknown
+	)
 
 
 class SendSpeechPacket(Packet):
@@ -437,6 +624,8 @@ class SendSpeechPacket(Packet):
 
 	cmd = 0x1c
 
+	__slots__ = ('length', 'serial', 'model', 'type', 'color', 'font', 'name', 'msg')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -460,10 +649,11 @@ class ControlAnimationPacket(Packet):
 	cmd = 0x1e
 	length = 4
 
-	def decodeChild(self):
-		self.duchar() # Unknown
-		self.duchar() # Unknown
-		self.duchar() # Unknown
+	fields = (
+		(None, 'B'), # Unknown
+		(None, 'B'), # Unknown
+		(None, 'B'), # Unknown
+	)
 
 
 class DrawGamePlayerPacket(Packet):
@@ -472,17 +662,18 @@ class DrawGamePlayerPacket(Packet):
 	cmd = 0x20
 	length = 19
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.graphic = self.dushort()
-		self.duchar() # unknown
-		self.hue = self.dushort()
-		self.flag = self.duchar()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.dushort() # unknown
-		self.direction = self.dschar()
-		self.z = self.dschar()
+	fields = (
+		('serial', 'I'),
+		('graphic', 'H'),
+		(None, 'B'), # Unknown
+		('hue', 'H'),
+		('flag', 'B'),
+		('x', 'H'),
+		('y', 'H'),
+		(None, 'H'), # Unknown
+		('direction', 'b'),
+		('z', 'b'),
+	)
 
 
 class MoveRejectPacket(Packet):
@@ -491,12 +682,13 @@ class MoveRejectPacket(Packet):
 	cmd = 0x21
 	length = 8
 
-	def decodeChild(self):
-		self.sequence = self.duchar()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.direction = self.dschar()
-		self.z = self.dschar()
+	fields = (
+		('sequence', 'B'),
+		('x', 'H'),
+		('y', 'H'),
+		('direction', 'b'),
+		('z', 'b'),
+	)
 
 
 class MoveAckPacket(Packet):
@@ -505,9 +697,10 @@ class MoveAckPacket(Packet):
 	cmd = 0x22
 	length = 3
 
-	def decodeChild(self):
-		self.sequence = self.duchar()
-		self.notoriety = self.duchar()
+	fields = (
+		('sequence', 'B'),
+		('notoriety', 'B'),
+	)
 
 
 class DrawContainerPacket(Packet):
@@ -516,9 +709,10 @@ class DrawContainerPacket(Packet):
 	cmd = 0x24
 	length = 7
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.gump = self.dushort()
+	fields = (
+		('serial', 'I'),
+		('gump', 'H'),
+	)
 
 
 class AddItemToContainerPacket(Packet):
@@ -527,15 +721,16 @@ class AddItemToContainerPacket(Packet):
 	cmd = 0x25
 	length = 20
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.graphic = self.dushort()
-		self.offset = self.duchar()
-		self.amount = self.dushort()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.container = self.duint()
-		self.color = self.dushort()
+	fields = (
+		('serial', 'I'),
+		('graphic', 'H'),
+		('offset', 'B'),
+		('amount', 'H'),
+		('x', 'H'),
+		('y', 'H'),
+		('container', 'I'),
+		('color', 'H'),
+	)
 
 
 class MobAttributesPacket(Packet):
@@ -544,14 +739,15 @@ class MobAttributesPacket(Packet):
 	cmd = 0x2d
 	length = 17
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.hits_max = self.dushort()
-		self.hits_current = self.dushort()
-		self.mana_max = self.dushort()
-		self.mana_current = self.dushort()
-		self.stam_max = self.dushort()
-		self.stam_current = self.dushort()
+	fields = (
+		('serial', 'I'),
+		('hits_max', 'H'),
+		('hits_current', 'H'),
+		('mana_max', 'H'),
+		('mana_current', 'H'),
+		('stam_max', 'H'),
+		('stam_current', 'H'),
+	)
 
 
 class Unk32Packet(Packet):
@@ -560,8 +756,9 @@ class Unk32Packet(Packet):
 	cmd = 0x32
 	length = 2
 
-	def decodeChild(self):
-		self.duchar()
+	fields = (
+		(None, 'B'), # Unknown
+	)
 
 
 class GetPlayerStatusPacket(Packet):
@@ -577,6 +774,8 @@ class GetPlayerStatusPacket(Packet):
 	cmd = 0x34
 	length = 10
 
+	__slots__ = ('type', 'serial')
+
 	def fill(self, type, serial):
 		'''
 		@param type int: What to request (see TYP_ constants)
@@ -597,26 +796,38 @@ class SendSkillsPacket(Packet):
 
 	cmd = 0x3a
 
+	# Constants for type
+	TYP_FULL = 0x00
+	TYP_FULL_CAP = 0x02
+	TYP_SINGLE_CAP = 0xdf
+	TYP_SINGLE = 0xff
+
+	## A skill record: id, value, base value (in tenths), lock status, internal usage
+	SKILL = struct.Struct('>HHHB')
+	## A skill record followed by the skill cap, internal usage
+	SKILL_CAP = struct.Struct('>HHHBH')
+
+	__slots__ = ('length', 'type', 'skills')
+
 	def decodeChild(self):
 		self.length = self.dushort()
-		typ = self.duchar() # 0x00 full list, 0xff single skill, 0x02 full with caps, 0xdf single with caps
-		self.skills = {}
-		while True:
-			try:
-				id = self.dushort()
-			except EOFError:
-				break
-			else:
-				if not id:
-					break
-			assert id not in self.skills
-			self.skills[id] = {
-				'id': id,
-				'val': self.dushort(), # Current value, in tenths
-				'base': self.dushort(), # Base value, in tenths
-				'lock': self.duchar(), # Lock status 0 = up, 1 = down, 2 =locked
-				'cap': self.dushort() if typ == 0x02 or typ == 0xdf else None
-			}
+		self.type = self.duchar()
+		st = self.SKILL_CAP if self.type in (self.TYP_FULL_CAP, self.TYP_SINGLE_CAP) else self.SKILL
+		# Full lists may end with a 0 id, shorter than a record
+		count = self.remaining() // st.size
+		## List of (id, value, base, lock) tuples, plus cap when sent: ids are 1 based in
+		## full lists and 0 based in single skill updates
+		self.skills = list(st.iter_unpack(self.rpb(count * st.size)))
+		if self.remaining() >= 2:
+			terminator = self.dushort()
+			if terminator != 0:
+				raise RuntimeError("Skills list terminated by 0x{:04x} instead of 0".format(terminator))
+		if self.remaining():
+			raise RuntimeError("{} unexpected bytes at the end of skills list".format(self.remaining()))
+
+	def isFull(self):
+		''' Tells whether this is a full skill list '''
+		return self.type in (self.TYP_FULL, self.TYP_FULL_CAP)
 
 
 class AddItemsToContainerPacket(Packet):
@@ -624,21 +835,17 @@ class AddItemsToContainerPacket(Packet):
 
 	cmd = 0x3c
 
+	__slots__ = ('length', 'items')
+
+	## Layout of a single item record
+	ITEM = struct.Struct('>IHBHHHIH')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		itemNum = self.dushort()
-		self.items = []
-		for i in range(0, itemNum):
-			self.items.append({
-				'serial': self.duint(),
-				'graphic': self.dushort(),
-				'unknown': self.duchar(),
-				'amount': self.dushort(),
-				'x': self.dushort(),
-				'y': self.dushort(),
-				'container': self.duint(),
-				'color': self.dushort(),
-			})
+		## List of ContainerItem, all records are unpacked in a single pass
+		self.items = list(map(ContainerItem._make,
+				self.ITEM.iter_unpack(self.rpb(itemNum * self.ITEM.size))))
 
 
 class OverallLightLevelPacket(Packet):
@@ -647,8 +854,9 @@ class OverallLightLevelPacket(Packet):
 	cmd = 0x4f
 	length = 2
 
-	def decodeChild(self):
-		self.level = self.duchar()
+	fields = (
+		('level', 'B'),
+	)
 
 
 class PlaySoundPacket(Packet):
@@ -657,13 +865,14 @@ class PlaySoundPacket(Packet):
 	cmd = 0x54
 	length = 12
 
-	def decodeChild(self):
-		self.mode = self.duchar()
-		self.model = self.dushort()
-		self.dushort() # unknown
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.z = self.dushort()
+	fields = (
+		('mode', 'B'),
+		('model', 'H'),
+		(None, 'H'), # Unknown
+		('x', 'H'),
+		('y', 'H'),
+		('z', 'H'),
+	)
 
 
 class LoginCompletePacket(Packet):
@@ -672,8 +881,7 @@ class LoginCompletePacket(Packet):
 	cmd = 0x55
 	length = 1
 
-	def decodeChild(self):
-		pass
+	fields = ()
 
 
 class LoginCharacterPacket(Packet):
@@ -682,6 +890,8 @@ class LoginCharacterPacket(Packet):
 	cmd = 0x5d
 	length = 73
 
+	__slots__ = ('name', 'idx')
+
 	def fill(self, name, idx):
 		'''!
 		@param name string: The character name
@@ -711,10 +921,11 @@ class SetWeatherPacket(Packet):
 	cmd = 0x65
 	length = 4
 
-	def decodeChild(self):
-		self.type = self.duchar()
-		self.num = self.duchar()
-		self.temp = self.duchar()
+	fields = (
+		('type', 'B'),
+		('num', 'B'),
+		('temp', 'B'),
+	)
 
 
 class TargetCursorPacket(Packet):
@@ -732,6 +943,23 @@ class TargetCursorPacket(Packet):
 	cmd = 0x6c
 	length = 19
 
+	__slots__ = ('serial', 'x', 'y', 'z', 'graphic')
+
+	fields = (
+		## 0 = object, 1 = location
+		('what', 'B'),
+		('id', 'I'),
+		## 0 = Neutral, 1 = Harmful, 2 = Helpful, 3 = Cancel (server sent)
+		('type', 'B'),
+		# Following data ignored when sent my server
+		(None, 'I'), # Clicked on
+		(None, 'H'), # x
+		(None, 'H'), # y
+		(None, 'B'), # unknown
+		(None, 'b'), # z
+		(None, 'H'), # graphic (if static tile)
+	)
+
 	def fill(self, what, id, type, serial, x=0, y=0, z=0, graphic=0):
 		'''!
 		@param what int: what to target, see constants
@@ -763,20 +991,6 @@ class TargetCursorPacket(Packet):
 		self.eschar(self.z)
 		self.eushort(self.graphic)
 
-	def decodeChild(self):
-		## 0 = object, 1 = location
-		self.what = self.duchar()
-		self.id = self.duint()
-		## 0 = Neutral, 1 = Harmful, 2 = Helpful, 3 = Cancel (server sent)
-		self.type = self.duchar()
-
-		# Following data ignored when sent my server
-		self.duint() # Clicked on
-		self.dushort() # x
-		self.dushort() # y
-		self.duchar() # unknown
-		self.dschar() # z
-		self.dushort() # graphic (if static tile)
 
 
 class PlayMidiPacket(Packet):
@@ -785,8 +999,9 @@ class PlayMidiPacket(Packet):
 	cmd = 0x6d
 	length = 3
 
-	def decodeChild(self):
-		self.music = self.dushort()
+	fields = (
+		('music', 'H'),
+	)
 
 
 class CharacterAnimationPacket(Packet):
@@ -795,15 +1010,16 @@ class CharacterAnimationPacket(Packet):
 	cmd = 0x6e
 	length = 14
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.action = self.dushort()
-		self.duchar() # unknown
-		self.frames = self.duchar()
-		self.repeat = self.dushort()
-		self.backwards = self.duchar()
-		self.repeat = self.duchar()
-		self.delay = self.duchar()
+	fields = (
+		('serial', 'I'),
+		('action', 'H'),
+		(None, 'B'), # Unknown
+		('frames', 'B'),
+		('repeat', 'H'),
+		('backwards', 'B'),
+		('repeat', 'B'),
+		('delay', 'B'),
+	)
 
 
 class GraphicalEffectPacket(Packet):
@@ -812,22 +1028,23 @@ class GraphicalEffectPacket(Packet):
 	cmd = 0x70
 	length = 28
 
-	def decodeChild(self):
-		self.direction = self.duchar()
-		self.serial = self.duint()
-		self.target = self.duint()
-		self.graphic = self.dushort()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.z = self.dschar()
-		self.tx = self.dushort()
-		self.ty = self.dushort()
-		self.tz = self.dschar()
-		self.speed = self.duchar()
-		self.duration = self.duchar()
-		self.dushort() # Unknown
-		self.adjust = self.duchar()
-		self.explode = self.duchar()
+	fields = (
+		('direction', 'B'),
+		('serial', 'I'),
+		('target', 'I'),
+		('graphic', 'H'),
+		('x', 'H'),
+		('y', 'H'),
+		('z', 'b'),
+		('tx', 'H'),
+		('ty', 'H'),
+		('tz', 'b'),
+		('speed', 'B'),
+		('duration', 'B'),
+		(None, 'H'), # Unknown
+		('adjust', 'B'),
+		('explode', 'B'),
+	)
 
 
 class WarModePacket(Packet):
@@ -836,11 +1053,12 @@ class WarModePacket(Packet):
 	cmd = 0x72
 	length = 5
 
-	def decodeChild(self):
-		self.war = self.duchar()
-		self.duchar() # unknown
-		self.duchar() # unknown
-		self.duchar() # unknown
+	fields = (
+		('war', 'B'),
+		(None, 'B'), # Unknown
+		(None, 'B'), # Unknown
+		(None, 'B'), # Unknown
+	)
 
 
 class PingPacket(Packet):
@@ -849,6 +1067,10 @@ class PingPacket(Packet):
 	cmd = 0x73
 	length = 2
 
+	fields = (
+		('seq', 'B'),
+	)
+
 	def fill(self, seq):
 		'''!
 		@param seq int: Sequence number
@@ -858,9 +1080,6 @@ class PingPacket(Packet):
 	def encodeChild(self):
 		self.euchar(self.seq)
 
-	def decodeChild(self):
-		self.seq = self.duchar()
-
 
 class UpdatePlayerPacket(Packet):
 	''' Updates a mobile '''
@@ -868,16 +1087,17 @@ class UpdatePlayerPacket(Packet):
 	cmd = 0x77
 	length = 17
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.graphic = self.dushort()
-		self.x = self.dushort()
-		self.y = self.dushort()
-		self.z = self.dschar()
-		self.facing = self.dschar()
-		self.color = self.dushort()
-		self.flag = self.duchar()
-		self.notoriety = self.duchar()
+	fields = (
+		('serial', 'I'),
+		('graphic', 'H'),
+		('x', 'H'),
+		('y', 'H'),
+		('z', 'b'),
+		('facing', 'b'),
+		('color', 'H'),
+		('flag', 'B'),
+		('notoriety', 'B'),
+	)
 
 
 class DrawObjectPacket(Packet):
@@ -885,6 +1105,14 @@ class DrawObjectPacket(Packet):
 
 	cmd = 0x78
 
+	__slots__ = (
+		'length', 'serial', 'graphic', 'x', 'y', 'z', 'facing', 'color', 'flag', 'notoriety',
+		'equip',
+	)
+
+	## Graphic and layer of an equipped item, internal usage
+	EQUIP = struct.Struct('>HB')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -901,18 +1129,12 @@ class DrawObjectPacket(Packet):
 			serial = self.duint()
 			if not serial:
 				break
-			graphic = self.dushort()
-			layer = self.duchar()
+			graphic, layer = self.dunpack(self.EQUIP)
 			if graphic & 0x8000:
 				color = self.dushort()
 			else:
 				color = 0
-			self.equip.append({
-				'serial': serial,
-				'graphic': graphic,
-				'layer': layer,
-				'color': color,
-			})
+			self.equip.append(EquipItem(serial, graphic, layer, color))
 #		if not len(self.equip):
 #			self.duchar() # unused/closing
 
@@ -923,6 +1145,8 @@ class LoginRequestPacket(Packet):
 	cmd = 0x80
 	length = 62
 
+	__slots__ = ('account', 'password', 'nlk')
+
 	def fill(self, account, password, nlk=0):
 		'''!
 		@param account string: The username
@@ -945,8 +1169,9 @@ class LoginDeniedPacket(Packet):
 	cmd = 0x82
 	length = 2
 
-	def decodeChild(self):
-		self.reason = self.duchar()
+	fields = (
+		('reason', 'B'),
+	)
 
 
 class ConnectToGameServerPacket(Packet):
@@ -955,6 +1180,8 @@ class ConnectToGameServerPacket(Packet):
 	cmd = 0x8c
 	length = 11
 
+	__slots__ = ('ip', 'port', 'key')
+
 	def decodeChild(self):
 		self.ip = self.dip()
 		self.port = self.dushort()
@@ -967,6 +1194,8 @@ class GameServerLoginPacket(Packet):
 	cmd = 0x91
 	length = 65
 
+	__slots__ = ('key', 'account', 'password')
+
 	def fill(self, key, account, password):
 		'''!
 		@param key: The key used
@@ -1006,6 +1235,8 @@ class TipWindowPacket(Packet):
 
 	cmd = 0xa6
 
+	__slots__ = ('length', 'flag', 'tipid', 'msg')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.flag = self.duchar()
@@ -1019,6 +1250,8 @@ class ServerListPacket(Packet):
 
 	cmd = 0xa8
 
+	__slots__ = ('length', 'flag', 'numServers', 'servers')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.flag = self.duchar()
@@ -1039,6 +1272,8 @@ class CharactersPacket(Packet):
 
 	cmd = 0xa9
 
+	__slots__ = ('length', 'numChars', 'chars', 'numLocs', 'locs', 'flags')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.numChars = self.duchar()
@@ -1093,6 +1328,8 @@ class UnicodeSpeechRequestPacket(Packet):
 
 	cmd = 0xad
 
+	__slots__ = ('type', 'lang', 'text', 'color', 'font', 'length')
+
 	def fill(self, type, lang, text, color, font):
 		'''!
 		@param type int: Speech type, see TYP_ constants
@@ -1123,6 +1360,8 @@ class UnicodeSpeechPacket(Packet):
 
 	cmd = 0xae
 
+	__slots__ = ('length', 'serial', 'model', 'type', 'color', 'font', 'lang', 'name', 'msg')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -1140,6 +1379,8 @@ class SendGumpDialogPacket(Packet):
 
 	cmd = 0xb0
 
+	__slots__ = ('length', 'serial', 'gumpid', 'x', 'y', 'commands', 'texts')
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
@@ -1156,14 +1397,55 @@ class SendGumpDialogPacket(Packet):
 		self.duchar() # Trailing byte? TODO: check this
 
 
+class GumpResponsePacket(Packet):
+	''' Gump menu selection, the reply to a gump '''
+
+	cmd = 0xb1
+
+	__slots__ = ('serial', 'gumpid', 'buttonid', 'switches', 'texts', 'length')
+
+	def fill(self, serial, gumpid, buttonid, switches=(), texts=None):
+		'''!
+		@param serial int: Serial of the gump
+		@param gumpid int: Type ID of the gump
+		@param buttonid int: ID of the pressed button, 0 to close the gump
+		@param switches list of int: IDs of the checked checkboxes and radios
+		@param texts dict: Text entries' content by entry ID
+		'''
+		self.serial = serial
+		self.gumpid = gumpid
+		self.buttonid = buttonid
+		self.switches = list(switches)
+		# Texts are encoded now: characters outside the BMP take 4 bytes
+		self.texts = [(id, text.encode('utf_16_be')) for id, text in sorted(texts.items())] \
+				if texts else []
+		self.length = 1 + 2 + 4 + 4 + 4 + 4 + len(self.switches)*4 + 4 + \
+				sum([4 + len(data) for id, data in self.texts])
+
+	def encodeChild(self):
+		self.eulen()
+		self.euint(self.serial)
+		self.euint(self.gumpid)
+		self.euint(self.buttonid)
+		self.euint(len(self.switches))
+		for switch in self.switches:
+			self.euint(switch)
+		self.euint(len(self.texts))
+		for id, data in self.texts:
+			self.eushort(id)
+			self.eushort(len(data) // 2)
+			self.ewrite(data)
+
+
 class EnableFeaturesPacket(Packet):
 	''' Used to enable client features '''
 
 	cmd = 0xb9
 	length = 3
 
-	def decodeChild(self):
-		self.features = self.dushort()
+	fields = (
+		('features', 'H'),
+	)
 
 
 class SeasonInfoPacket(Packet):
@@ -1172,9 +1454,10 @@ class SeasonInfoPacket(Packet):
 	cmd = 0xbc
 	length = 3
 
-	def decodeChild(self):
-		self.flag = self.duchar()
-		self.sound = self.duchar()
+	fields = (
+		('flag', 'B'),
+		('sound', 'B'),
+	)
 
 
 class ClientVersionPacket(Packet):
@@ -1182,6 +1465,8 @@ class ClientVersionPacket(Packet):
 
 	cmd = 0xbd
 
+	__slots__ = ('version', 'length')
+
 	def fill(self, version):
 		'''!
 		@param version string: The client, version, as string
@@ -1228,6 +1513,11 @@ class GeneralInfoPacket(Packet):
 
 	cmd = 0xbf
 
+	__slots__ = (
+		'sub', 'length', 'keys', 'lang', 'key', 'gumpid', 'buttonid', 'x', 'y', 'data', 'cursor',
+		'serial', 'animation', 'maps', 'revision', 'rev',
+	)
+
 	def fill(self, sub, *args):
 		'''!
 		@param sub int: The subcommand, see SUB_ constants
@@ -1291,7 +1581,7 @@ class GeneralInfoPacket(Packet):
 			unk = self.dushort()
 
 		elif self.sub == self.SUB_PARTY:
-			self.data = self.rpb(len(self.buf))
+			self.data = bytes(self.rpb(self.remaining()))
 
 		elif self.sub == self.SUB_CURSORMAP:
 			self.cursor = self.duchar()
@@ -1334,6 +1624,10 @@ class ClilocMsgPacket(Packet):
 
 	cmd = 0xc1
 
+	__slots__ = (
+		'length', 'id', 'body', 'type', 'hue', 'font', 'msg', 'speaker_name', 'unicode_string',
+	)
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.id = self.duint()
@@ -1343,7 +1637,7 @@ class ClilocMsgPacket(Packet):
 		self.font = self.dushort()
 		self.msg = self.duint()
 		self.speaker_name = self.dstring(30)
-		self.unicode_string = self.rpb(self.length-48)
+		self.unicode_string = bytes(self.rpb(self.length-48))
 
 
 class MegaClilocRevPacket(Packet):
@@ -1352,32 +1646,46 @@ class MegaClilocRevPacket(Packet):
 	cmd = 0xdc
 	length = 9
 
-	def decodeChild(self):
-		self.serial = self.duint()
-		self.revision = self.duint()
+	fields = (
+		('serial', 'I'),
+		('revision', 'I'),
+	)
 
 
 class CompressedGumpPacket(Packet):
-	''' Receiving a compressed gump from the server '''
+	''' Receiving a compressed gump from the server
+
+	Layout and texts are kept compressed, gump.Gump inflates them when needed
+	'''
 
 	cmd = 0xdd
 
+	__slots__ = (
+		'length', 'serial', 'gumpid', 'x', 'y', 'commandsData', 'commandsLength',
+		'textLines', 'textsData', 'textsLength',
+	)
+
 	def decodeChild(self):
 		self.length = self.dushort()
 		self.serial = self.duint()
 		self.gumpid = self.duint()
 		self.x = self.duint()
 		self.y = self.duint()
+		self.commandsData, self.commandsLength = self.dpacked()
+		self.textLines = self.duint()
+		self.textsData, self.textsLength = self.dpacked()
+		#self.duchar() # Trailing byte?
+
+	def dpacked(self):
+		'''! Returns next zlib compressed block from the receive buffer, internal usage
+		@return tuple (compressed bytes, inflated length)
+		'''
 		cLen = self.duint()
+		if not cLen:
+			# Empty block, no inflated length is sent
+			return b'', 0
 		dLen = self.duint()
-		self.commands = zlib.decompress(self.rpb(cLen-4))
-		assert len(self.commands) == dLen
-		textLines = self.duint()
-		ctxtLen = self.duint()
-		dtxtLen = self.duint()
-		self.texts = zlib.decompress(self.rpb(ctxtLen-4))
-		assert len(self.texts) == dtxtLen
-		#self.duchar() # Trailing byte?
+		return bytes(self.rpb(cLen-4)), dLen
 
 
 ################################################################################
@@ -1385,11 +1693,23 @@ class CompressedGumpPacket(Packet):
 ################################################################################
 
 
-''' Builds list of currectly defined packets, as a dict of classes sorted by ID '''
-classes = {}
-for name, obj in inspect.getmembers(sys.modules[__name__]):
-	if inspect.isclass(obj) and hasattr(obj, 'cmd'):
-		cmd = obj.cmd
-		if cmd in classes.keys():
-			raise RuntimeError("Duplicate packet 0x{:02x}".format(cmd))
-		classes[cmd] = obj
+## Marker used in lengths for variable length packets
+VARIABLE = -1
+
+''' Builds the registry of currently defined packets, indexed by ID '''
+## Packet class by ID, None for unknown packets
+registry = [None] * 256
+## Packet length by ID: the fixed length, VARIABLE, or None for unknown packets
+lengths = [None] * 256
+for cls in PacketMeta.defined:
+	if registry[cls.cmd] is not None:
+		raise RuntimeError("Duplicate packet 0x{:02x}".format(cls.cmd))
+	registry[cls.cmd] = cls
+	length = cls.fixedLength()
+	lengths[cls.cmd] = VARIABLE if length is None else length
+del cls, length
+registry = tuple(registry)
+lengths = tuple(lengths)
+
+## Dict of defined packet classes by ID
+classes = {cmd: cls for cmd, cls in enumerate(registry) if cls is not None}
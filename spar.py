@@ -8,7 +8,6 @@ import configparser
 import logging
 import http.client
 import json
-import time
 
 from pyuo import client
 from pyuo import brain
@@ -22,35 +21,37 @@ class MyBrain(brain.Brain):
 	CHUCK_INTERVAL = 60
 
 	def init(self):
-		self.nextChuck = time.time() + self.CHUCK_INTERVAL
-		self.nextHeal = 0
+		self.canHeal = True
+		self.schedule(self.CHUCK_INTERVAL, self.chuck, interval=self.CHUCK_INTERVAL)
 		self.client.say("Hello, world!")
 
 	#def onHpChange(self, old, new):
-		#if self.player.hp < self.player.maxhp - 10 and time.time() > self.nextHeal:
+		#if self.player.hp < self.player.maxhp - 10 and self.canHeal:
 			## Heal myself
 			#bp = self.player.openBackPack()
-			#for item in bp:
-				#if item.graphic == self.CLEAN_BANDAGES:
-					#print("Using bandages")
-					#item.use()
-					#tgt = self.client.waitForTarget(timeout=10)
-					#if tgt:
-						#self.nextHeal = time.time() + 10
-						#tgt.target(self.player)
+			#for item in self.client.findObjects(graphic=self.CLEAN_BANDAGES, container=bp.serial):
+				#print("Using bandages")
+				#item.use()
+				#tgt = self.client.waitForTarget(timeout=10)
+				#if tgt:
+					#self.canHeal = False
+					#self.schedule(10, setattr, self, 'canHeal', True)
+					#tgt.target(self.player)
 
 	def loop(self):
+		# Everything is driven by events and timers
+		pass
+
+	def chuck(self):
 		# Say a Chuck Norris Fact
-		if time.time() > self.nextChuck:
-			try:
-				conn = http.client.HTTPConnection('api.icndb.com', timeout=5)
-				conn.request("GET", "/jokes/random")
-				res = json.loads(conn.getresponse().read().decode('utf8'))
-				if res['type'] == 'success':
-					self.client.say(res['value']['joke'])
-			except Exception as e:
-				self.log.error(str(e))
-			self.nextChuck = time.time() + self.CHUCK_INTERVAL
+		try:
+			conn = http.client.HTTPConnection('api.icndb.com', timeout=5)
+			conn.request("GET", "/jokes/random")
+			res = json.loads(conn.getresponse().read().decode('utf8'))
+			if res['type'] == 'success':
+				self.client.say(res['value']['joke'])
+		except Exception as e:
+			self.log.error(str(e))
 
 
 if __name__ == '__main__':
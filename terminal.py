@@ -245,8 +245,8 @@ class Ui(brain.Brain):
 
 	def updMobiles(self):
 		mobiles = []
-		for obj in self.client.objects.values():
-			if isinstance(obj,client.Mobile) and obj.serial != self.player.serial:
+		for obj in self.client.findObjects(client.Mobile):
+			if obj.serial != self.player.serial:
 				mobiles.append(obj)
 		self.mwin.updMobiles(mobiles)
 		self.mwin.refresh()
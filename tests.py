@@ -7,7 +7,16 @@ Do some consistency checks on the sources
 import unittest
 
 import re
+import struct
 import inspect
+import socket
+import asyncio
+import threading
+import zlib
+import random
+import os
+import tempfile
+import time
 
 # Even if it's bad pratice, import everything to check for syntax errors
 from pyuo import *
@@ -20,6 +29,563 @@ class TestClient(unittest.TestCase):
 		''' Chec that an instance can be created '''
 		cli = client.Client()
 
+	def testContainerItems(self):
+		''' Container content is added in bulk '''
+		cli = client.Client()
+		cont = client.Container(cli)
+		cont.serial = 0x40001000
+		cli.objects[cont.serial] = cont
+		cont.addItems([packets.ContainerItem(0x40000000 + i, 0x0e21, 0, i, 10, 20, cont.serial, 0)
+				for i in range(1, 4)])
+		cont.addItem({'serial': 0x40000004, 'graphic': 0x0f0e, 'amount': 5, 'x': 1, 'y': 2,
+				'container': cont.serial, 'color': 0})
+		self.assertEqual([it.amount for it in cont], [1, 2, 3, 5])
+		self.assertIs(cli.objects[0x40000001], cont[0])
+		self.assertEqual(cont[3].graphic, 0x0f0e)
+
+	def testEquip(self):
+		''' Mobile's equipment is decoded into records and only changed layers are updated '''
+		equip = struct.pack('>IHB', 0x40000001, 0x1515, 0x05) + \
+				struct.pack('>IHBH', 0x40000002, 0x8f0e, 0x15, 0x21) + b'\x00\x00\x00\x00'
+		body = struct.pack('>IHHHbbHBB', 0x00000005, 0x0190, 1000, 1000, 0, 2, 0, 0, 1) + equip
+		pkt = packets.DrawObjectPacket()
+		pkt.decode(struct.pack('>BH', 0x78, len(body) + 3) + body)
+		self.assertEqual(pkt.equip[1], packets.EquipItem(0x40000002, 0x8f0e, 0x15, 0x21))
+
+		cli = client.Client()
+		mob = client.Mobile(cli, pkt)
+		shirt = mob.getEquipByLayer(mob.LAYER_SHIRT)
+		self.assertIs(cli.objects[0x40000001], shirt)
+		self.assertEqual(mob.getEquipByLayer(mob.LAYER_PACK).color, 0x21)
+
+		before = mob.equip
+		mob.updateEquip([packets.EquipItem(0x40000001, 0x1516, 0x05, 0)])
+		self.assertIsNot(mob.equip, before)
+		self.assertEqual(len(before), 2)
+		self.assertIs(mob.getEquipByLayer(mob.LAYER_SHIRT), shirt)
+		self.assertEqual(shirt.graphic, 0x1516)
+		self.assertEqual(list(mob.equip.keys()), [mob.LAYER_SHIRT])
+		self.assertEqual(cli.findObjects(container=mob.serial), [shirt])
+		self.assertIsNone(cli.objects[0x40000002].container)
+
+		# Replaced and moved items
+		mob.updateEquip([packets.EquipItem(0x40000002, 0x8f0e, 0x15, 0),
+				packets.EquipItem(0x40000003, 0x1517, 0x05, 0)])
+		self.assertEqual(sorted([it.serial for it in cli.findObjects(container=mob.serial)]),
+				[0x40000002, 0x40000003])
+		self.assertIsNone(shirt.container)
+
+	def testSkillTable(self):
+		''' Full skill lists fill the table, single updates patch it '''
+		full = b''.join([struct.pack('>HHHBH', i + 1, i * 10, i * 5, 0, 1000) for i in range(58)])
+		full = struct.pack('>BHB', 0x3a, len(full) + 6, 0x02) + full + b'\x00\x00'
+		single = b'\x3a\x00\x0b\xff\x00\x03\x01\x2c\x01\x00\x02'
+		table = client.SkillTable()
+		for raw in (full, single):
+			pkt = packets.SendSkillsPacket()
+			pkt.decode(raw)
+			table.update(pkt)
+		self.assertEqual(table.count, 58)
+		self.assertEqual(table.get(57), (57, 570, 285, 0, 1000))
+		self.assertEqual(table.get(3), (3, 300, 256, 2, 1000))
+		self.assertEqual(table.value[2], 20)
+
+		pkt = packets.SendSkillsPacket()
+		self.assertRaisesRegex(RuntimeError, 'unexpected bytes', pkt.decode, single + b'\x00')
+
+	def testEvents(self):
+		''' Events are slotted and tell their type '''
+		ev = brain.HpChangedEvent(10, 20)
+		self.assertEqual((ev.type, ev.old, ev.new), (brain.Event.EVT_HP_CHANGED, 10, 20))
+		self.assertFalse(hasattr(ev, '__dict__'))
+
+	def testHandlers(self):
+		''' Packets are dispatched by ID, handlers can be replaced and chained '''
+		cli = client.Client()
+		cli.status = 'game'
+		seen = []
+		def handler(pkt):
+			seen.append(pkt.cmd)
+			default(pkt)
+		default = cli.registerHandler(packets.SendSkillsPacket, handler)
+		self.assertEqual(default, cli.handleSendSkillsPacket)
+		pkt = packets.SendSkillsPacket()
+		pkt.decode(b'\x3a\x00\x0b\xff\x00\x03\x01\x2c\x01\x00\x02')
+		cli.handlePacket(pkt)
+		self.assertEqual(seen, [0x3a])
+		self.assertEqual(cli.skills.get(3).value, 300)
+		self.assertIs(cli.registerHandler(0x3a, None), handler)
+		self.assertNotIn(0x3a, cli.handlers)
+
+		# Skipped packets are decoded once handled
+		self.assertIn(packets.PlaySoundPacket.cmd, cli.skip)
+		reader = net.PacketReader()
+		cli.net = reader
+		reader.skip = cli.skip
+		cli.registerHandler(packets.PlaySoundPacket, seen.append)
+		self.assertNotIn(packets.PlaySoundPacket.cmd, reader.skip)
+		raw = b'\x54\x01\x00\x30\x00\x00\x03\xe8\x03\xe8\x00\x00'
+		reader.getBuffer()[:len(raw)] = raw
+		reader.bufferUpdated(len(raw))
+		cli.handlePacket(reader.decodeNext())
+		self.assertEqual(seen[-1].model, 0x30)
+
+	def testWaitFor(self):
+		''' Waiters wake up when the client notifies a change '''
+		cli = client.Client()
+		self.assertFalse(cli.waitFor(lambda: cli.target is not None, 0.01))
+		def change():
+			cli.target = True
+			cli.notifyChanged()
+		timer = threading.Timer(0.05, change)
+		timer.start()
+		self.assertTrue(cli.waitFor(lambda: cli.target is not None, 10))
+		timer.join()
+
+	def testBrain(self):
+		''' The brain wakes up for events and timers '''
+		class FakeClient:
+			player = None
+			objects = {}
+			def start(self, ai):
+				ai.event(brain.HpChangedEvent(10, 20))
+				ai.started.set()
+			def is_alive(self):
+				return True
+		class TestBrain(brain.Brain):
+			def init(self):
+				self.calls = []
+				self.setTimeout(0.01)
+				self.schedule(0.02, self.calls.append, 'repeat', interval=0.01)
+				self.schedule(0, self.calls.append, 'cancelled').cancel()
+			def loop(self):
+				return self.calls.count('repeat') >= 2
+			def onHpChange(self, old, new):
+				self.calls.append(new)
+		ai = TestBrain(FakeClient())
+		self.assertEqual(ai.calls[:3], [20, 'repeat', 'repeat'])
+
+	def testSpatialIndex(self):
+		''' Range and nearest queries match a full scan '''
+		cli = client.Client()
+		grid = cli.grid
+		objs = []
+		for i in range(200):
+			obj = client.Item(cli)
+			obj.serial = 0x40000000 + i
+			obj.x = (i * 37) % 97 + 1000
+			obj.y = (i * 53) % 89 + 2000
+			grid.place(obj)
+			objs.append(obj)
+		objs[0].x = 1050
+		grid.place(objs[0])
+		grid.remove(objs[1].serial)
+		objs = objs[:1] + objs[2:]
+		self.assertEqual(len(grid), len(objs))
+
+		dist = lambda o: max(abs(o.x - 1040), abs(o.y - 2030))
+		self.assertEqual(set(grid.inRange(1040, 2030, 12)), set([o for o in objs if dist(o) <= 12]))
+		near = grid.nearest(1040, 2030, lambda o: o.serial % 7 == 0)
+		self.assertEqual(dist(near), min([dist(o) for o in objs if o.serial % 7 == 0]))
+		self.assertIsNone(grid.nearest(1040, 2030, lambda o: False))
+		self.assertIsNone(grid.nearest(0, 0, maxRange=100))
+
+		# Queries from another thread survive concurrent changes
+		stop = threading.Event()
+		def churn():
+			while not stop.is_set():
+				for obj in objs[:50]:
+					grid.remove(obj.serial)
+				for obj in objs[:50]:
+					grid.place(obj)
+		thread = threading.Thread(target=churn)
+		thread.start()
+		try:
+			for i in range(300):
+				list(grid.inRange(1040, 2030, 40))
+				grid.nearest(1040, 2030)
+		finally:
+			stop.set()
+			thread.join()
+
+	def testObjectIndex(self):
+		''' Objects are found by class, graphic, container and notoriety '''
+		cli = client.Client()
+		cont = client.Container(cli)
+		cont.serial = 0x40001000
+		cont.graphic = 0x0e75
+		cli.objects[cont.serial] = cont
+		cli.index.update(cont)
+		cont.addItems([packets.ContainerItem(0x40000000 + i, 0x0e21 if i % 2 else 0x0f0e, 0, 1,
+				10, 20, cont.serial, 0) for i in range(1, 7)])
+		bandages = cli.findObjects(graphic=0x0e21, container=cont.serial)
+		self.assertEqual(sorted([it.serial for it in bandages]), [0x40000001, 0x40000003, 0x40000005])
+		self.assertEqual(len(cli.findObjects(client.Item)), 7)
+		self.assertEqual(cli.findObjects(client.Container), [cont])
+
+		mob = client.Mobile(cli)
+		mob.serial = 0x00000005
+		mob.notoriety = client.Mobile.NOTO_MURDERER
+		cli.index.update(mob)
+		self.assertEqual(cli.findObjects(notoriety=client.Mobile.NOTO_MURDERER), [mob])
+		mob.notoriety = client.Mobile.NOTO_INNOCENT
+		cli.index.update(mob)
+		self.assertEqual(cli.findObjects(notoriety=client.Mobile.NOTO_MURDERER), [])
+		self.assertEqual(cli.findObjects(client.Mobile, notoriety=client.Mobile.NOTO_INNOCENT), [mob])
+
+		cli.index.remove(0x40000001)
+		self.assertEqual(len(cli.findObjects(graphic=0x0e21)), 2)
+
+	def testMainloopWakeup(self):
+		''' A packet queued from another thread wakes up the idle main loop '''
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		cli = client.Client()
+		cli.net = net.Network('127.0.0.1', listener.getsockname()[1])
+		srv, addr = listener.accept()
+		listener.close()
+		self.addCleanup(cli.net.close)
+		cli.status = 'game'
+		cli.IDLE_INTERVAL = 30
+
+		errors = []
+		def loop():
+			try:
+				cli.mainloop()
+			except net.DisconnectedError as e:
+				errors.append(e)
+		thread = threading.Thread(target=loop)
+		thread.start()
+		while cli.wakeupSend is None:
+			time.sleep(0.001)
+		time.sleep(0.05) # Let the loop go idle
+
+		srv.settimeout(5)
+		cli.queue(b'\x73\x00')
+		self.assertEqual(srv.recv(16), b'\x73\x00')
+
+		# Disconnecting terminates the loop, closing the wakeup sockets
+		srv.close()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(len(errors), 1)
+		self.assertIsNone(cli.wakeupSend)
+
+	def testLoopbackLogin(self):
+		''' Logs in to the local loopback server '''
+		srv = loopback.LoopbackServer()
+		srv.start()
+		self.addCleanup(srv.close)
+		cli = client.Client()
+		tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(tmp.cleanup)
+		cli.record = open(os.path.join(tmp.name, 'corpus'), 'wb')
+		self.addCleanup(cli.record.close)
+		servers = cli.connect(srv.host, srv.port, 'test', 'test')
+		chars = cli.selectServer(servers[0]['idx'])
+		self.assertEqual(chars[0]['name'], 'Tester')
+		cli.selectCharacter(chars[0]['name'], 0)
+		pkts = []
+		while len(pkts) < 3:
+			pkts.extend(cli.net.recvMany())
+		self.assertEqual([p.cmd for p in pkts], [0x1b, 0x20, 0x55])
+		self.assertEqual(pkts[0].serial, srv.SERIAL)
+		cli.net.close()
+		cli.record.close()
+
+		# Both phases have been recorded
+		import benchmark
+		plain, compressed = benchmark.loadCorpus(cli.record.name)
+		self.assertEqual([raw[0] for raw in plain], [0xa8, 0x8c])
+		self.assertEqual([raw[0] for raw in compressed], [0xb9, 0xa9, 0x1b, 0x20, 0x55])
+
+
+class TestNet(unittest.TestCase):
+	''' Network layer tests '''
+
+	def testDecompressorStreaming(self):
+		''' Packets split over many reads are decompressed correctly '''
+		datas = [b'\x55', bytes(range(256)) * 3, b'\x00\xff' * 50]
+		stream = b''.join([net.Compressor.compress(d) for d in datas])
+
+		d = net.Decompressor()
+		done = []
+		for i in range(0, len(stream), 7):
+			done.extend(d.decompress(stream[i:i+7]))
+		self.assertEqual([raw for raw, size in done], datas)
+		self.assertEqual(sum([size for raw, size in done]), len(stream))
+
+		raw, size = net.Network.decompress(stream)
+		self.assertEqual(raw, datas[0])
+		self.assertEqual(size, len(net.Compressor.compress(datas[0])))
+
+	def testDecompressorTable(self):
+		''' The transitions table decodes like a bit by bit walk of the tree '''
+		def walk(buf):
+			done = []
+			dest = bytearray()
+			node = 0
+			for byte in buf:
+				for bitNum in range(7, -1, -1):
+					leafVal = net.Network.DECOMPRESSION_TREE[node][(byte >> bitNum) & 1]
+					if leafVal == -256:
+						done.append(bytes(dest))
+						dest = bytearray()
+						node = 0
+						break
+					elif leafVal < 1:
+						dest.append(-leafVal)
+						leafVal = 0
+					node = leafVal
+			return done
+
+		rnd = random.Random(1)
+		for i in range(20):
+			buf = bytes([rnd.randrange(256) for j in range(rnd.randrange(1, 300))])
+			d = net.Decompressor()
+			done = d.decompress(buf[:len(buf)//2]) + d.decompress(buf[len(buf)//2:])
+			self.assertEqual([raw for raw, size in done], walk(buf))
+
+	def connect(self):
+		''' Returns a connected (Network, server socket) pair '''
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		nw = net.Network('127.0.0.1', listener.getsockname()[1])
+		srv, addr = listener.accept()
+		listener.close()
+		self.addCleanup(nw.close)
+		self.addCleanup(srv.close)
+		return nw, srv
+
+	def testRecvCompressed(self):
+		''' Compressed packets are read through a small receive buffer '''
+		nw, srv = self.connect()
+		nw.buf = bytearray(16)
+		nw.compress = True
+		pkts = [b'\x1d\x00\x00\x00\x01', b'\x22\x01\x03'] * 20
+		srv.sendall(b''.join([net.Compressor.compress(p) for p in pkts]))
+		for raw in pkts:
+			pkt = nw.recv()
+			self.assertEqual(pkt.cmd, raw[0])
+			self.assertIsNone(pkt.buf)
+
+	def testRecvMany(self):
+		''' All the packets arrived with a single read are returned at once '''
+		nw, srv = self.connect()
+		nw.compress = True
+		self.assertEqual(nw.recvMany(blocking=False), [])
+		pkts = [b'\x1d\x00\x00\x00\x01', b'\x22\x01\x03', b'\x4f\x10']
+		srv.sendall(b''.join([net.Compressor.compress(p) for p in pkts]))
+		self.assertEqual([p.cmd for p in nw.recvMany()], [raw[0] for raw in pkts])
+
+	def testLazyDecoding(self):
+		''' Lazy packets are decoded on first access, skipped ones never '''
+		nw, srv = self.connect()
+		nw.compress = True
+		nw.lazy = True
+		nw.skip = frozenset([packets.PlaySoundPacket.cmd])
+		pkts = [b'\x54\x01\x00\x30\x00\x00\x03\xe8\x03\xe8\x00\x00', b'\x1d\x00\x00\x00\x01']
+		srv.sendall(b''.join([net.Compressor.compress(p) for p in pkts]))
+		sound = nw.recv()
+		self.assertIsInstance(sound, packets.PlaySoundPacket)
+		self.assertFalse(hasattr(sound, 'model'))
+		delete = nw.recv()
+		self.assertFalse(delete.validated)
+		self.assertEqual(delete.serial, 1)
+		self.assertTrue(delete.validated)
+
+		# A failed decode is raised again at every access
+		broken = packets.DeleteObjectPacket()
+		broken.decodeLazy(b'\x1d\x00\x00')
+		for i in range(2):
+			self.assertRaises(EOFError, getattr, broken, 'serial')
+		self.assertRaises(AttributeError, getattr, delete, 'nothing')
+
+	def testRecvUncompressed(self):
+		''' Uncompressed packets sharing a read are split by length '''
+		nw, srv = self.connect()
+		servers = b'\xa8\x00\x2e\x5d\x00\x01' + b'\x00\x00' + b'pyuo'.ljust(32, b'\x00') + \
+				b'\x00\x00\x7f\x00\x00\x01'
+		connect = b'\x8c\x7f\x00\x00\x01\x0a\x21\x00\x00\x00\x2a'
+		srv.sendall(servers + connect[:4])
+		pkt = nw.recv()
+		self.assertEqual(pkt.servers[0]['name'], 'pyuo')
+		self.assertEqual(nw.recvMany(blocking=False), [])
+		srv.sendall(connect[4:])
+		pkt = nw.recv()
+		self.assertEqual((pkt.port, pkt.key), (2593, 42))
+
+	def testSendMany(self):
+		''' Queued packets are all written, also on a non blocking socket '''
+		nw, srv = self.connect()
+		nw.sock.setblocking(False)
+		ping = packets.PingPacket()
+		ping.fill(1)
+		data = []
+		def read():
+			while sum(map(len, data)) < 5000002:
+				data.append(srv.recv(65536))
+		reader = threading.Thread(target=read)
+		reader.start()
+		nw.sendMany([b'\x00' * 5000000, ping])
+		reader.join()
+		self.assertEqual(b''.join(data)[-2:], b'\x73\x01')
+
+	def testAsyncNetwork(self):
+		''' The asyncio network reads the same stream '''
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		self.addCleanup(listener.close)
+		pkts = [b'\x1d\x00\x00\x00\x01', b'\x22\x01\x03', b'\x4f\x10']
+
+		async def run():
+			anw = await asyncnet.Network.connect('127.0.0.1', listener.getsockname()[1])
+			srv, addr = listener.accept()
+			anw.compress = True
+			await anw.send(b'\x73\x00')
+			self.assertEqual(srv.recv(2), b'\x73\x00')
+			srv.sendall(b''.join([net.Compressor.compress(p) for p in pkts]))
+			srv.close()
+			return [pkt.cmd async for pkt in anw]
+
+		self.assertEqual(asyncio.run(run()), [raw[0] for raw in pkts])
+
+	def testBenchmark(self):
+		''' The benchmark replays its corpus and flags regressions '''
+		import benchmark
+		raws = benchmark.samples()
+		corpus = benchmark.syntheticCorpus(raws)
+		stream = b''.join([net.Compressor.compress(raw) for raw in corpus])
+		self.assertEqual(benchmark.replay(stream), len(corpus))
+		plain = benchmark.syntheticCorpus(raws, benchmark.LOGIN)
+		self.assertEqual(benchmark.replay(b''.join(plain), False), len(plain))
+
+		# Every decodable packet has a sample
+		for cmd, cls in enumerate(packets.registry):
+			if cls is not None and (cls.fieldsStruct is not None or 'decodeChild' in cls.__dict__):
+				self.assertIn(cmd, raws, cls.__name__)
+
+		baseline = {'decode': {'pps': 1000, 'blocks': 4}}
+		self.assertEqual(benchmark.compare({'decode': {'pps': 900, 'blocks': 4}}, baseline, 0.25), [])
+		self.assertEqual(len(benchmark.compare({'decode': {'pps': 700, 'blocks': 7}}, baseline, 0.25)), 2)
+
+
+class TestPackets(unittest.TestCase):
+	''' Packets encoding and decoding tests '''
+
+	def testFieldsDecoding(self):
+		''' Packets declaring fields are decoded at once '''
+		pkt = packets.MobAttributesPacket()
+		pkt.decode(b'\x2d\x00\x00\x00\x05\x00\x64\x00\x32\x00\x0a\x00\x05\x00\x14\x00\x0f')
+		self.assertEqual((pkt.serial, pkt.hits_max, pkt.hits_current, pkt.mana_max,
+				pkt.mana_current, pkt.stam_max, pkt.stam_current), (5, 100, 50, 10, 5, 20, 15))
+
+		pkt = packets.MoveRejectPacket()
+		pkt.decode(b'\x21\x07\x03\xe8\x00\x10\x02\xfb')
+		self.assertEqual((pkt.sequence, pkt.x, pkt.y, pkt.direction, pkt.z), (7, 1000, 16, 2, -5))
+
+	def testCursorDecoding(self):
+		''' Variable length packets are read in place up to their end '''
+		items = [(0x40000000 + i, 0x0e21, 0, i + 1, 10, 20, 0x40001000, 0) for i in range(300)]
+		raw = struct.pack('>H', len(items)) + b''.join([struct.pack('>IHBHHHIH', *i) for i in items])
+		raw = struct.pack('>BH', 0x3c, len(raw) + 3) + raw
+		pkt = packets.AddItemsToContainerPacket()
+		pkt.decode(raw)
+		self.assertEqual(len(pkt.items), 300)
+		self.assertEqual(pkt.items[-1].amount, 300)
+		self.assertEqual(pkt.items[-1].container, 0x40001000)
+
+		# Full skill list ends at the end of the buffer
+		pkt = packets.SendSkillsPacket()
+		pkt.decode(b'\x3a\x00\x0d\x00\x00\x01\x00\x64\x00\x50\x02\x00\x00')
+		self.assertTrue(pkt.isFull())
+		self.assertEqual(pkt.skills, [(1, 100, 80, 2)])
+
+	def testEncoding(self):
+		''' Packets are encoded in place, length is patched '''
+		pkt = packets.UnicodeSpeechRequestPacket()
+		pkt.fill(pkt.TYP_NORMAL, 'ENU', 'Hi', 0x0034, 3)
+		self.assertEqual(pkt.encode(), b'\xad\x00\x12\x00\x00\x34\x00\x03ENU\x00\x00H\x00i\x00\x00')
+
+		class LongPingPacket(packets.PingPacket):
+			length = 3
+		pkt = LongPingPacket()
+		pkt.fill(1)
+		self.assertRaises(RuntimeError, pkt.encode)
+
+	def testGump(self):
+		''' Compressed gumps are inflated and parsed on first access, replies reuse them '''
+		layout = (b'{ page 0 }{ resizepic 0 0 5054 200 200 }{ text 10 10 0 0 }'
+				b'{ button 10 40 4005 4007 1 0 7 }{ checkbox 10 70 210 211 1 3 }'
+				b'{ page 1 }{ textentry 10 100 80 20 0 5 1 }\x00')
+		texts = [t.encode('utf_16_be') for t in ('Hello', 'Name')]
+		texts = b''.join([struct.pack('>H', len(t) // 2) + t for t in texts])
+		def packed(data):
+			comp = zlib.compress(data)
+			return struct.pack('>II', len(comp) + 4, len(data)) + comp
+		body = struct.pack('>IIII', 0x1234, 0x99, 50, 60) + packed(layout) + \
+				struct.pack('>I', 2) + packed(texts)
+		pkt = packets.CompressedGumpPacket()
+		pkt.decode(struct.pack('>BH', 0xdd, len(body) + 3) + body)
+
+		gmp = gump.Gump(pkt)
+		self.assertIsNone(gmp.layoutCache)
+		self.assertEqual([e.__class__ for e in gmp.elements], [gump.Page, gump.Element,
+				gump.Label, gump.Button, gump.Switch, gump.Page, gump.TextEntry])
+		self.assertIs(gmp.elements, gmp.elements)
+		self.assertEqual(gmp.elements[2].text, 'Hello')
+		self.assertEqual(gmp.textEntries[0], gump.TextEntry(1, 10, 100, 80, 20, 0, 5, 'Name', None))
+
+		self.assertRaises(ValueError, gmp.response, 8)
+		po = gmp.response(7, texts={5: 'Bob'})
+		self.assertEqual(po.encode(), b'\xb1\x00\x25\x00\x00\x12\x34\x00\x00\x00\x99'
+				b'\x00\x00\x00\x07\x00\x00\x00\x01\x00\x00\x00\x03\x00\x00\x00\x01'
+				b'\x00\x05\x00\x03\x00B\x00o\x00b')
+		po = gmp.response(0, texts={5: 'B\U0001f600'})
+		self.assertEqual(len(po.encode()), po.length)
+		self.assertEqual(po.encode()[-10:], b'\x00\x05\x00\x03\x00B\xd8\x3d\xde\x00')
+
+		cli = client.Client()
+		cli.status = 'game'
+		cli.gumps[gmp.gumpid] = gmp
+		close = packets.GeneralInfoPacket()
+		close.decode(struct.pack('>BHHII', 0xbf, 13, close.SUB_CLOSEGUMP, gmp.gumpid, 0))
+		cli.handlePacket(close)
+		self.assertEqual(cli.gumps, {})
+
+	def testSlots(self):
+		''' Packet instances have no __dict__ '''
+		for cmd, cls in packets.classes.items():
+			self.assertFalse(hasattr(cls(), '__dict__'), cls.__name__)
+
+	def testRegistry(self):
+		''' The registry maps every ID to its class and length '''
+		self.assertEqual((len(packets.registry), len(packets.lengths)), (256, 256))
+		for cmd in range(256):
+			cls = packets.registry[cmd]
+			if cls is None:
+				self.assertIsNone(packets.lengths[cmd])
+				self.assertNotIn(cmd, packets.classes)
+				continue
+			self.assertIs(packets.classes[cmd], cls)
+			self.assertEqual(cls.cmd, cmd)
+			if cls.fixedLength() is None:
+				self.assertEqual(packets.lengths[cmd], packets.VARIABLE)
+			else:
+				self.assertEqual(packets.lengths[cmd], cls.length)
+		self.assertEqual(net.PacketReader.frameLength(b'\x22\x01\x03'), 3)
+		self.assertEqual(net.PacketReader.frameLength(b'\x3c\x00\x05'), 5)
+		self.assertIsNone(net.PacketReader.frameLength(b'\x3c\x00'))
+
+	def testFieldsLength(self):
+		''' Declared fields match the declared packet length '''
+		for cmd, cls in packets.classes.items():
+			if cls.fields is not None and cls.fixedLength() is not None:
+				self.assertEqual(cls.fieldsStruct.size + 1, cls.length, cls.__name__)
+
 
 class TestSource(unittest.TestCase):
 	''' Source code tests '''